@@ -44,7 +44,7 @@ After installation as plugin. It can be run from command in pymol
             string: Give a custom list of protein structures to superimpose. Specifying this list will disable 'sequence identity' and 'resolution cutoff' parameters. {default: disabled}
 
     linkage method
-            string: Linkage method for hierarchical clustering. Choose one from single, complete, average. {default: complete}
+            string: Linkage method for hierarchical clustering. Choose one from single, complete, average or density. The density method finds hydration sites by grid hashing and density peaks in near-linear time instead of hierarchical clustering; in large families it finds somewhat more conserved waters than complete linkage. {default: complete}
 
     inconsistency coefficient threshold
             float: Any two clusters of water molecules will not be closer than given inconsistency coefficient threshold. Value ranges from 0 to 2.8. {default: 2.4} 
@@ -52,6 +52,86 @@ After installation as plugin. It can be run from command in pymol
     degree of conservation
             float: Water molecules will be considered CONSERVED if their probability of being conserved is above given cutoff. Value ranges from 0 to 1. {default: 0.7} 
 
+    atlas_dir
+            string: Water atlas built by pywater_atlas. Chains found in the atlas are superimposed by their C-alpha traces and their waters are loaded from the atlas instead of PDB files. {default: disabled}
+
+    query_anchored
+            bool: Cluster only the waters of other chains which can reach a water of the query chain, i.e. which are within the inconsistency coefficient threshold of one. Exact for single linkage, approximate (and labelled as such in the output files) otherwise. {default: False}
+
+    anchor_selection
+            string: PyMOL selection, evaluated after superposition, restricting the query waters used as anchors, e.g. 'resn hoh within 8 of organic'. Implies query_anchored. {default: disabled}
+
+    work_dir
+            string: Directory in which the output of every stage (members, metadata, downloads, superposition, refinement, clustering and extraction) is kept, keyed by a hash of its inputs and parameters. A re-run reuses the stages whose inputs did not change, e.g. changing only the refinement method recomputes refinement, clustering and extraction. The reused stages are reported in the log. {default: disabled}
+
+    index_dir
+            string: Local PDB index built by pywater_index. Sequence clusters, experimental methods and resolutions are looked up in the index instead of the RCSB web services. {default: disabled}
+
+    progressive
+            int: Progressive preview. The query and the best resolved chains (this many) are processed first and their provisional conserved waters are shown with 95 % confidence intervals; the run is repeated with twice as many chains until all chains are used, replacing the display and output files each time. {default: disabled}
+
+    confidence
+            string: 'bootstrap' or 'jackknife'. Resample the member chains to estimate a 95 % confidence interval of the degree of conservation of every query water, written to xxxx_x_confidence.txt. No re-clustering is needed. {default: disabled}
+
+    resamples
+            int: Number of bootstrap resamples. {default: 1000}
+
+    stability
+            float: Stability selection instead of the fixed degree of conservation cutoff: a water is conserved if its degree of conservation reaches the cutoff in at least this fraction of the bootstrap resamples, e.g. 0.8. Implies bootstrap. {default: disabled}
+
+    n_procs
+            int: Number of worker processes preparing the pdb chains. Every worker parses its chains without PyMOL, superimposes them onto the first chain by their C-alpha traces (matched by residue number) and returns their superimposed waters and superposition statistics. Chains which can not be matched are superimposed by PyMOL. {default: 1, all chains are prepared by PyMOL}
+
+    map_spacing
+            float: Grid spacing (A) of a density map of all superimposed water oxygen atoms, smoothed by a gaussian and saved as cwm_xxxx_x_waterDensity.ccp4 (CCP4/MRC format). A density of 1 is a water at the same position in every structure. It is displayed as a mesh at half the degree of conservation cutoff, e.g. 0.5. {default: disabled}
+
+    map_extent
+            float: Margin (A) of the density map around the query chain; 0 for a map around all waters. {default: 5.0}
+
+Water atlas:
+
+    pywater_atlas structure directory, atlas directory
+
+    Indexes all PDB files of a local structure directory once into a sharded water atlas of water oxygen atoms, B-factors, occupancies and C-alpha traces.
+
+Local PDB index:
+
+    pywater_index bulk file directory, index directory
+
+    Indexes the bulk BlastClust sequence cluster files (bc-30.out ... bc-100.out) and the entry listings (entries.idx, resolu.idx) of the PDB once, so queries with index_dir need no RCSB web services.
+
+Molecular dynamics trajectories:
+
+    pywater_trajectory trajectory [, topology [, chain [, inconsistency coefficient threshold [, degree of conservation [, query_frame [, stride [, chunk [, shell]]]]]]]]
+
+    Finds conserved hydration sites in the frames of a multi-model PDB file, or of a DCD/XTC trajectory with its topology (requires MDAnalysis). Frames are streamed in chunks, so the memory does not grow with the number of frames.
+
+Transfer of conserved waters:
+
+    pywater_transfer sites file, structure, chain [, degree of conservation]
+
+    Every run saves the hydration sites of its family in xxxx_x_sites.npz. The transfer superimposes the chain of a new or apo structure (PDB file or PDB id) onto the family query and assigns its waters to the conserved sites; empty sites are saved as predicted waters.
+
+Batch runs:
+
+    pywater_batch_manifest queries file, batch directory [, shards [, parameters of pywater]]
+    pywater_batch batch directory [, shard]
+    pywater_batch_merge batch directory
+
+    Splits the queries into shards in a directory shared by all nodes. Every node claims queries with lock files, checkpoints each finished query atomically and resumes where it stopped. The checkpoints are merged into one index of conserved waters.
+
+Service:
+
+    pywater_server [port [, host [, work_dir [, index_dir [, max_jobs [, max_queue [, n_procs [, expiry]]]]]]]]
+
+    Keeps PyWATER running with warm caches and answers jobs over a local HTTP API: POST /jobs, GET /jobs, GET /jobs/<id>, GET /jobs/<id>/result and GET /stats (latencies and cache hit rates).
+
+Scaling benchmark:
+
+    pywater_benchmark [chains [, waters per chain [, clustering methods [, baseline file [, report file [, record]]]]]]
+
+    Measures time and peak memory of the clustering and extraction stages on synthetic superimposed chains, offline. Fails if the scaling exponents exceed the recorded baseline.
+
 """
 
 import os
@@ -62,16 +142,43 @@ import collections
 import tempfile
 from xml.dom.minidom import parseString
 import sys
+import json
+import gzip
+import time
+import socket
+import errno
+import hashlib
+import copy
+import multiprocessing
+import threading
+import struct
+import uuid
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    import MDAnalysis
+except ImportError:
+    MDAnalysis = None
 
 if sys.version_info[0] > 2:
     import urllib.request as urllib
     from tkinter import *
     import tkinter.messagebox as tkMessageBox
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    import queue as Queue
     xrange = range
 else:
     import urllib
     from Tkinter import *
     import tkMessageBox
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    import Queue
 
 import pymol.cmd as cmd
 import logging
@@ -83,6 +190,8 @@ except:
 
 try:
     import scipy.cluster.hierarchy as hcluster
+    from scipy.spatial import cKDTree
+    from scipy import ndimage
 except:
     sys.exit('Scipy not found')
 
@@ -110,6 +219,8 @@ ch.setFormatter(formatter)
 logger.addHandler(fh)
 logger.addHandler(ch)
 
+online_pdb_db = 'http://www.pdb.org/pdb/files/%s.pdb'
+
 
 # initialize as PyMOL plugin
 def __init__(self):
@@ -148,7 +259,8 @@ Enter the pdb chains list in format: xxxx_x,yyyy_y,zzzz_z""")
 
 def clustering_method_help():
     tkMessageBox.showinfo(title = 'Clustering linkage method',
-        message = """Choose any of the linkage method for hierarchical clustering. Default method is 'complete'.""")
+        message = """Choose any of the linkage method for hierarchical clustering. Default method is 'complete'.
+The 'density' method finds hydration sites by grid hashing and density peaks with at most one water per structure in each site. It runs in near-linear time and is not limited to 50000 water molecules. In large families it finds somewhat more conserved waters than complete linkage.""")
 
 def inconsistency_coefficient_help():
     tkMessageBox.showinfo(title = 'Inconsistency coefficient threshold', 
@@ -182,19 +294,22 @@ def displayInputs( selectedStruturePDB, selectedStrutureChain,
     logger.info( 'probability cutoff : %s' % prob)
 
 # display PyMOL session with identified conserved waters, showing H-bonds with other conserved waters, ligands or protein.
-def displayInPyMOL(outdir, selectedPDBChain, atomNumbersProbDic):
+def displayInPyMOL(outdir, selectedPDBChain, atomNumbersProbDic, density_map=None, level=0.35):
     pdbCWMs = os.path.join(outdir, '%s_withConservedWaters.pdb' % selectedPDBChain)
     pdb = os.path.join(outdir, '%s.pdb' % selectedPDBChain)
     h_bond_dist = 4.0
 
     queryProteinCWMs = '%s_withConservedWaters' % selectedPDBChain
 
+    # replace an earlier display of the same query, e.g. of a progressive preview
+    for name in (queryProteinCWMs, 'conserved_waters', 'DOC', 'PW_HB*', 'LW_HB*', 'HW_HB*', 'water_density', 'water_density_mesh'):
+        cmd.delete(name)
     cmd.load(pdbCWMs)
     cmd.orient(queryProteinCWMs)
     cmd.h_add(queryProteinCWMs)
 
     cmd.select('cwm_protein','polymer and %s' % queryProteinCWMs)
-    cmd.select('cwm_waters','resn hoh and %s' % queryProteinCWMs)
+    cmd.select('cwm_waters','%s and %s' % (WATER_SELECTION, queryProteinCWMs))
     cmd.select('cwm_ligand','organic and %s' % queryProteinCWMs)
 
     cmd.select('don', '(elem n,o and (neighbor hydro)) and %s' % queryProteinCWMs)
@@ -225,8 +340,9 @@ def displayInPyMOL(outdir, selectedPDBChain, atomNumbersProbDic):
     MinDoc = min(atomNumbersProbDic.values())
     MaxDoc = max(atomNumbersProbDic.values())
     cmd.create ('conserved_waters','cwm_waters')
+    # any chain and water residue name, e.g. of a trajectory
     for key, value in atomNumbersProbDic.items():
-        cmd.alter('/conserved_waters//A/HOH`%s/O' % key, 'b=%s' % value)
+        cmd.alter('conserved_waters and resi %s and name %s' % (key, '+'.join(WATER_OXYGENS)), 'b=%s' % value)
 
     cmd.spectrum('b', 'red_blue', 'conserved_waters',minimum=MinDoc, maximum=MaxDoc)
     cmd.ramp_new('DOC', 'conserved_waters', range = [MinDoc,MaxDoc], color = '[red,blue]')
@@ -243,13 +359,22 @@ def displayInPyMOL(outdir, selectedPDBChain, atomNumbersProbDic):
     cmd.set('surface_color', 'gray', 'cwm_protein')
 
     cmd.load(pdb)
-    cmd.create('all_waters', 'resn hoh and %s' % selectedPDBChain)
+    cmd.create('all_waters', '%s and %s' % (WATER_SELECTION, selectedPDBChain))
     cmd.color('red','ss h and %s' % selectedPDBChain)
     cmd.color('yellow','ss s and %s' % selectedPDBChain)
     cmd.color('green','ss l+ and %s' % selectedPDBChain)
     cmd.show_as('cartoon', selectedPDBChain)
     cmd.set('ray_shadows', 0)
 
+    if density_map and os.path.exists(density_map):
+        # keep the densities (degrees of conservation) instead of normalizing the map to sigma levels
+        normalize = cmd.get('normalize_ccp4_maps')
+        cmd.set('normalize_ccp4_maps', 0)
+        cmd.load(density_map, 'water_density')
+        cmd.set('normalize_ccp4_maps', normalize)
+        cmd.isomesh('water_density_mesh', 'water_density', level)
+        cmd.color('blue', 'water_density_mesh')
+
 
 def okMobility( pdbFile, mobilityCutoff = 2.0 ):
     """
@@ -333,6 +458,139 @@ def okBfactor( pdbFile, normBCutoff = 1.0 ):
     return considerPDB
 
 
+def refinementMask( bfactors, occupancies, refinement, mobilityCutoff = 2.0, normBCutoff = 1.0 ):
+    """
+    Array version of okMobility and okBfactor. Returns a boolean mask of the
+    water oxygen atoms to keep or None if more than 50 % of the water oxygen
+    atoms are removed and the whole chain is discarded.
+    """
+    bfactors = np.asarray(bfactors, dtype=float)
+    occupancies = np.asarray(occupancies, dtype=float)
+    keep = np.ones(len(bfactors), dtype=bool)
+    if len(bfactors) == 0 or refinement == 'No refinement':
+        return keep
+    if refinement == 'Mobility':
+        mobility = (bfactors / np.mean(bfactors)) / (occupancies / np.mean(occupancies))
+        keep = mobility < mobilityCutoff
+    elif refinement == 'Normalized B-factor':
+        normB = (bfactors - np.mean(bfactors)) / np.sqrt(np.var(bfactors))
+        keep = normB < normBCutoff
+    count = len(keep) - np.count_nonzero(keep)
+    logger.info( 'Water oxygen atoms removed by %s: %s' % (refinement, count))
+    if count > (len(keep) / 2.0):
+        return None
+    return keep
+
+
+def readPDBLines( pdbFile ):
+    """
+        Read a plain or gzipped PDB file.
+    """
+    if pdbFile.endswith('.gz'):
+        handle = gzip.open(pdbFile, 'rb')
+        lines = handle.read().decode('ascii', 'replace').splitlines(True)
+    else:
+        handle = open(pdbFile)
+        lines = handle.readlines()
+    handle.close()
+    return lines
+
+
+def parseChainsFromPDB( pdbFile, chains = None ):
+    """
+        Parse the water oxygen atoms and the C-alpha trace of every chain (or only
+        the given chains) from the first model of a PDB file, without PyMOL.
+        Like the PyMOL preparation, hydrogens are skipped and DOD is read as HOH.
+        Returns a dictionary: chain id -> dictionary of numpy arrays.
+    """
+    return parseChainsFromLines(readPDBLines(pdbFile), chains)
+
+
+def parseChainsFromLines( lines, chains = None ):
+    """
+        parseChainsFromPDB for the lines of a PDB file which was already read.
+    """
+    parsed = {}
+    seenCA = set()
+    for line in lines:
+        if line.startswith('ENDMDL'):
+            break
+        if not line.startswith(('ATOM', 'HETATM')):
+            continue
+        chain = line[21]
+        if chains is not None and chain not in chains:
+            continue
+        resn = line[17:20].strip()
+        name = line[12:16].strip()
+        if resn in ('HOH', 'DOD', 'WAT'):
+            if not name.startswith('O'):
+                continue
+        elif not (line.startswith('ATOM') and name == 'CA' and line[16] in ' A'):
+            continue
+        if chain not in parsed:
+            parsed[chain] = {'water_coordinates': [], 'water_serials': [], 'bfactors': [],
+                'occupancies': [], 'ca_coordinates': [], 'ca_residues': []}
+        record = parsed[chain]
+        coordinates = [float(line[30:38]), float(line[38:46]), float(line[46:54])]
+        resi = int(line[22:26])
+        if resn in ('HOH', 'DOD', 'WAT'):
+            record['water_coordinates'].append(coordinates)
+            record['water_serials'].append(resi)
+            record['occupancies'].append(float(line[54:60].strip() or 1.0))
+            record['bfactors'].append(float(line[60:66].strip() or 0.0))
+        elif (chain, resi) not in seenCA:
+            seenCA.add((chain, resi))
+            record['ca_coordinates'].append(coordinates)
+            record['ca_residues'].append(resi)
+    for chain, record in parsed.items():
+        record['water_coordinates'] = np.array(record['water_coordinates'], dtype=np.float32).reshape(-1, 3)
+        record['water_serials'] = np.array(record['water_serials'], dtype=np.int32)
+        record['bfactors'] = np.array(record['bfactors'], dtype=np.float32)
+        record['occupancies'] = np.array(record['occupancies'], dtype=np.float32)
+        record['ca_coordinates'] = np.array(record['ca_coordinates'], dtype=np.float32).reshape(-1, 3)
+        record['ca_residues'] = np.array(record['ca_residues'], dtype=np.int32)
+    return parsed
+
+
+def kabsch( mobile, target ):
+    """
+        Rotation matrix and translation vector which superimpose the mobile
+        coordinates onto the target coordinates with minimal RMSD.
+    """
+    mobileCenter = mobile.mean(axis=0)
+    targetCenter = target.mean(axis=0)
+    H = np.dot((mobile - mobileCenter).T, target - targetCenter)
+    U, S, Vt = np.linalg.svd(H)
+    d = np.sign(np.linalg.det(np.dot(Vt.T, U.T)))
+    R = np.dot(Vt.T, np.dot(np.diag([1.0, 1.0, d]), U.T))
+    t = targetCenter - np.dot(R, mobileCenter)
+    return R, t
+
+
+def superposeCATraces( mobileCA, mobileResidues, targetCA, targetResidues, cycles = 5, cutoff = 2.0 ):
+    """
+        Superimpose two C-alpha traces matched by residue number. Like the
+        outlier rejection of PyMOL, pairs farther apart than cutoff times the
+        RMSD are rejected in each cycle.
+        Returns (rotation, translation, rmsd, number of aligned atoms) or None if
+        less than half of the mobile trace could be matched.
+    """
+    common, mobileIdx, targetIdx = np.intersect1d(mobileResidues, targetResidues, return_indices=True)
+    if len(common) < max(3, len(mobileResidues) / 2):
+        return None
+    mobile = np.asarray(mobileCA, dtype=float)[mobileIdx]
+    target = np.asarray(targetCA, dtype=float)[targetIdx]
+    for cycle in xrange(cycles + 1):
+        R, t = kabsch(mobile, target)
+        distances = np.sqrt(((np.dot(mobile, R.T) + t - target) ** 2).sum(axis=1))
+        rmsd = np.sqrt(np.mean(distances ** 2))
+        keep = distances <= cutoff * rmsd
+        if cycle == cycles or keep.all() or keep.sum() < 3:
+            break
+        mobile, target = mobile[keep], target[keep]
+    return R, t, rmsd, len(mobile)
+
+
 class Protein():
     def __init__(self, pdb_id, chain=False):
         self.pdb_id = pdb_id.lower()
@@ -342,11 +600,26 @@ class Protein():
         self.water_coordinates = list()
         self.water_ids = list()
         self.waterIDCoordinates = {}
+        self.from_arrays = False
 
     def __repr__(self):
         return "%s_%s" % (self.pdb_id, self.chain)
 
+    def set_water_coordinates(self, coordinates, serials):
+        """
+            Set already superimposed water coordinates, e.g. loaded from the water atlas or prepared in parallel.
+        """
+        for coordinate, serial in zip(coordinates, serials):
+            key = "%s_%s" % (self.__repr__(), int(serial))
+            coordinate = [float(c) for c in coordinate]
+            self.waterIDCoordinates[key] = coordinate
+            self.water_coordinates.append( coordinate )
+            self.water_ids.append( key )
+        return self.waterIDCoordinates
+
     def calculate_water_coordinates(self, tmp_dir = False):
+        if self.from_arrays:
+            return self.waterIDCoordinates
         path = os.path.join( tmp_dir, 'cwm_%s_Water.pdb' % self.__repr__() )
         logger.debug( 'Creating water coordinates of cwm_%s_Water.pdb.' % self.__repr__())
         for line in open(path):
@@ -369,6 +642,16 @@ class ProteinsList():
         self.probability = 0.7
         self.inconsistency_coefficient = 2.0
         self.refinement = ''
+        self.atlas = None
+        self.query_anchored = False
+        self.anchor_selection = ''
+        self.anchor_waters = None
+        self.confidence = ''
+        self.resamples = 1000
+        self.stability = 0.0
+        self.n_procs = 1
+        self.map_spacing = 0.0
+        self.map_extent = 5.0
 
     def add_protein(self, protein):
         self.proteins.add(protein)
@@ -416,247 +699,1479 @@ class ProteinsList():
             raise TypeError("Invalid argument type.")
 
 
-def makePDBwithConservedWaters(ProteinsList, temp_dir, outdir, save_sup_files):
-    logger.info( 'Minimum desired degree of conservation is : %s' % ProteinsList.probability )
-    cmd.delete('cwm_*')
-    logger.info( 'Loading all pdb chains ...' )
-    for protein in ProteinsList:
-        cmd.load(os.path.join(temp_dir, protein.pdb_filename),'cwm_%s' % protein.pdb_id)
-        cmd.remove('(hydro) and cwm_%s' % protein.pdb_id)
-        cmd.select('dods','resn dod')
-        cmd.alter('dods', 'resn="HOH"')
-        cmd.create('cwm_%s' % protein, 'cwm_%s & chain %s' % (protein.pdb_id, protein.chain))
-        cmd.delete( 'cwm_%s' % protein.pdb_id )
-
-    logger.info( 'Superimposing all pdb chains ...' )
+ATLAS_ARRAYS = ('water_coordinates', 'water_serials', 'bfactors', 'occupancies', 'ca_coordinates', 'ca_residues')
+
+
+class WaterAtlas():
+    """
+        Precomputed store of water oxygen atoms (coordinates in the deposited frame,
+        residue numbers, B-factors, occupancies) and C-alpha traces keyed by pdb chain, e.g. 1axb_A.
+        The atlas is sharded like the PDB archive by the middle two characters of the PDB id.
+        Each shard holds one .npy file per array with all chains concatenated and an
+        index.json with the slice of every chain, so that shards are memory mapped.
+    """
+    def __init__(self, atlas_dir):
+        self.atlas_dir = atlas_dir
+        self.shards = {}
+
+    def _shard(self, pdb_id):
+        folder = pdb_id.lower()[1:3]
+        if folder not in self.shards:
+            shard_dir = os.path.join(self.atlas_dir, folder)
+            index = {'chains': {}, 'sources': {}}
+            arrays = {}
+            if os.path.exists(os.path.join(shard_dir, 'index.json')):
+                index = json.load(open(os.path.join(shard_dir, 'index.json')))
+                for name in ATLAS_ARRAYS:
+                    arrays[name] = np.load(os.path.join(shard_dir, '%s.npy' % name), mmap_mode='r')
+            self.shards[folder] = (index, arrays)
+        return self.shards[folder]
+
+    def __contains__(self, key):
+        key = str(key)
+        return key in self._shard(key[:4])[0]['chains']
+
+    def get(self, key):
+        """
+            Returns a dictionary of memory mapped arrays for the given pdb chain.
+        """
+        key = str(key)
+        index, arrays = self._shard(key[:4])
+        waters_start, waters_end, ca_start, ca_end = index['chains'][key]
+        entry = {}
+        for name in ATLAS_ARRAYS:
+            if name.startswith('ca_'):
+                entry[name] = arrays[name][ca_start:ca_end]
+            else:
+                entry[name] = arrays[name][waters_start:waters_end]
+        return entry
+
+    def source(self, pdb_id):
+        """
+            Path of the structure file the given PDB entry was indexed from.
+        """
+        return self._shard(pdb_id)[0]['sources'].get(pdb_id.lower())
+
+
+def writeAtlasShard( shard_dir, entries ):
+    """
+        Parse all (pdb id, structure file) entries of one shard and write the shard arrays and index.
+    """
+    arrays = dict((name, []) for name in ATLAS_ARRAYS)
+    index = {'chains': {}, 'sources': {}}
+    n_waters = n_ca = 0
+    for pdb_id, path in sorted(entries):
+        try:
+            chains = parseChainsFromPDB(path)
+        except Exception as e:
+            logger.warning( 'Could not parse %s: %s' % (path, e))
+            continue
+        index['sources'][pdb_id] = os.path.abspath(path)
+        for chain, record in sorted(chains.items()):
+            waters = len(record['water_serials'])
+            ca = len(record['ca_residues'])
+            index['chains']['%s_%s' % (pdb_id, chain)] = [n_waters, n_waters + waters, n_ca, n_ca + ca]
+            n_waters += waters
+            n_ca += ca
+            for name in ATLAS_ARRAYS:
+                arrays[name].append(record[name])
+    tmp_dir = shard_dir + '.tmp'
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    for name in ATLAS_ARRAYS:
+        if arrays[name]:
+            array = np.concatenate(arrays[name])
+        elif name in ('water_coordinates', 'ca_coordinates'):
+            array = np.zeros((0, 3), dtype=np.float32)
+        else:
+            array = np.zeros(0, dtype=np.float32)
+        np.save(os.path.join(tmp_dir, '%s.npy' % name), array)
+    with open(os.path.join(tmp_dir, 'index.json'), 'w') as handle:
+        json.dump(index, handle)
+    # replace an older shard only after the new one is complete
+    if os.path.exists(shard_dir):
+        shutil.rmtree(shard_dir)
+    os.rename(tmp_dir, shard_dir)
+    return len(index['chains'])
+
+
+def buildWaterAtlas( structure_dir, atlas_dir ):
+    """
+        Bulk index all PDB files found below structure_dir (1abc.pdb, pdb1abc.ent or
+        pdb1abc.ent.gz, flat or divided layout) into a water atlas in atlas_dir.
+    """
+    pattern = re.compile(r'^(?:pdb)?([0-9][a-z0-9]{3})\.(?:pdb|ent)(?:\.gz)?$', re.IGNORECASE)
+    shards = {}
+    for root, dirs, files in os.walk(structure_dir):
+        for name in files:
+            match = pattern.match(name)
+            if match:
+                pdb_id = match.group(1).lower()
+                shards.setdefault(pdb_id[1:3], []).append((pdb_id, os.path.join(root, name)))
+    if not os.path.exists(atlas_dir):
+        os.makedirs(atlas_dir)
+    n_chains = 0
+    for folder, entries in sorted(shards.items()):
+        logger.info( 'Indexing shard %s with %i structures ...' % (folder, len(entries)))
+        n_chains += writeAtlasShard(os.path.join(atlas_dir, folder), entries)
+    logger.info( 'Water atlas in %s contains %i pdb chains.' % (atlas_dir, n_chains))
+    return n_chains
+
+
+def retrieveStructure( pdb_id, tmp_dir, atlas = None ):
+    """
+        Copy a structure from the local file recorded in the water atlas or download it from the PDB.
+    """
+    path = os.path.join(tmp_dir, '%s.pdb' % pdb_id)
+    if os.path.exists(path):
+        return path
+    source = atlas.source(pdb_id) if atlas is not None else None
+    if source and os.path.exists(source):
+        logger.info( 'Copying structure %s from %s' % (pdb_id, source))
+        with open(path, 'w') as handle:
+            handle.write(''.join(readPDBLines(source)))
+    else:
+        logger.info( 'Retrieving structure: %s' % pdb_id)
+        urllib.urlretrieve(online_pdb_db % pdb_id.upper(), path)
+    return path
+
+
+def loadChainsFromAtlas( ProteinsList, structure_dir, stage_dir ):
+    """
+        Superimpose the chains stored in the water atlas onto the first chain of ProteinsList
+        by their C-alpha traces, without reading their PDB files, and save their superimposed
+        waters as cwm_xxxx_x_Water.npz in stage_dir.
+        Returns the list of proteins taken from the atlas.
+    """
+    atlas = ProteinsList.atlas
+    reference = ProteinsList[0]
+    if str(reference) in atlas:
+        referenceEntry = atlas.get(reference)
+    else:
+        referenceEntry = parseChainsFromPDB(structurePath(reference.pdb_id, structure_dir, stage_dir, atlas), [reference.chain]).get(reference.chain)
+    if referenceEntry is None:
+        return []
+    atlasProteins = []
     for protein in ProteinsList[1:]:
-        logger.info( 'Superimposing %s' % protein )
-        cmd.super('cwm_%s////CA' % protein, 'cwm_%s////CA' % ProteinsList[0])
-        cmd.orient( 'cwm_%s' % ProteinsList[0] )
+        if str(protein) == str(ProteinsList.selectedPDBChain) or str(protein) not in atlas:
+            continue
+        entry = atlas.get(protein)
+        superposition = superposeCATraces(entry['ca_coordinates'], entry['ca_residues'],
+            referenceEntry['ca_coordinates'], referenceEntry['ca_residues'])
+        if superposition is None:
+            logger.info( '%s could not be matched to %s by residue numbers, it is superimposed by PyMOL.' % (protein, reference))
+            continue
+        R, t, rmsd, n_aligned = superposition
+        logger.info( 'Superimposing %s from the water atlas (RMSD %.2f over %i C-alpha atoms)' % (protein, rmsd, n_aligned))
+        protein.from_arrays = True
+        atlasProteins.append(protein)
+        np.savez(os.path.join(stage_dir, 'cwm_%s_Water.npz' % protein),
+            water_coordinates = np.dot(np.asarray(entry['water_coordinates'], dtype=float), R.T) + t,
+            water_serials = entry['water_serials'],
+            bfactors = entry['bfactors'],
+            occupancies = entry['occupancies'])
+    return atlasProteins
+
+
+def structurePath( pdb_id, structure_dir, stage_dir, atlas = None ):
+    """
+        Path of a downloaded structure, retrieved into stage_dir if it was not downloaded before.
+    """
+    path = os.path.join(structure_dir, '%s.pdb' % pdb_id)
+    if os.path.exists(path):
+        return path
+    return retrieveStructure(pdb_id, stage_dir, atlas)
 
-    logger.info( 'Creating new, water only, pymol objects for each pdb chain ...' )
-    for protein in ProteinsList:
-        cmd.create('cwm_%s_Water' % protein, 'cwm_%s & resname hoh' % protein)
 
-    logger.info( 'Storing water molecules and proteins in separate pdb files for each pdb chain ...' )
-    for protein in ProteinsList:
-        cmd.save(os.path.join(temp_dir, 'cwm_%s.pdb' % protein), 'cwm_%s' % protein)
-        cmd.save(os.path.join(temp_dir, 'cwm_%s_Water.pdb' % protein), 'cwm_%s_Water' % protein)
+def prepareChain( task ):
+    """
+        Prepare one chain without PyMOL, in a worker process of prepareChainsInParallel: parse the
+        chain, superimpose it onto the reference C-alpha trace and save the superimposed chain
+        (without hydrogens, DOD read as HOH) as cwm_xxxx_x.pdb in stage_dir.
+        Returns (chain name, superimposed water arrays, quality statistics); the arrays are None if
+        the chain could not be matched to the reference by residue numbers.
+    """
+    name, pdbFile, chain, referenceCA, referenceResidues, stage_dir = task
+    start = time.time()
+    lines = readPDBLines(pdbFile)
+    entry = parseChainsFromLines(lines, [chain]).get(chain)
+    if entry is None:
+        return name, None, {'error': 'chain %s not found' % chain}
+    superposition = superposeCATraces(entry['ca_coordinates'], entry['ca_residues'], referenceCA, referenceResidues)
+    if superposition is None:
+        return name, None, {'error': 'not matched by residue numbers'}
+    R, t, rmsd, n_aligned = superposition
+    out = open(os.path.join(stage_dir, 'cwm_%s.pdb' % name), 'w')
+    for line in lines:
+        if line.startswith('ENDMDL'):
+            break
+        if not line.startswith(('ATOM', 'HETATM')) or line[21] != chain:
+            continue
+        element = line[76:78].strip() or line[12:16].strip().lstrip('0123456789')[:1]
+        if element in ('H', 'D'):
+            continue
+        if line[17:20] == 'DOD':
+            line = line[:17] + 'HOH' + line[20:]
+        x, y, z = np.dot(R, [float(line[30:38]), float(line[38:46]), float(line[46:54])]) + t
+        out.write('%s%8.3f%8.3f%8.3f%s' % (line[:30], x, y, z, line[54:]))
+    out.write('END\n')
+    out.close()
+    waters = {
+        'water_coordinates': np.dot(entry['water_coordinates'].astype(float), R.T) + t,
+        'water_serials': entry['water_serials'],
+        'bfactors': entry['bfactors'],
+        'occupancies': entry['occupancies'],
+    }
+    quality = {'rmsd': float(rmsd), 'aligned': int(n_aligned), 'ca': len(entry['ca_residues']),
+        'waters': len(entry['water_serials']), 'seconds': time.time() - start}
+    return name, waters, quality
+
+
+def prepareChainsInParallel( ProteinsList, structure_dir, stage_dir ):
+    """
+        Prepare the chains of ProteinsList (except the first chain, the superposition reference,
+        and the query) in ProteinsList.n_procs worker processes with prepareChain and save their
+        superimposed waters as cwm_xxxx_x_Water.npz in stage_dir. Chains already taken from the
+        water atlas are skipped, chains which can not be matched are left to PyMOL.
+        Returns the list of prepared proteins and a dictionary of their quality statistics.
+    """
+    reference = ProteinsList[0]
+    referenceEntry = parseChainsFromPDB(structurePath(reference.pdb_id, structure_dir, stage_dir, ProteinsList.atlas), [reference.chain]).get(reference.chain)
+    if referenceEntry is None:
+        return [], {}
+    proteins = dict((str(protein), protein) for protein in ProteinsList[1:]
+        if not protein.from_arrays and str(protein) != str(ProteinsList.selectedPDBChain))
+    tasks = [(name, structurePath(protein.pdb_id, structure_dir, stage_dir, ProteinsList.atlas), protein.chain,
+        referenceEntry['ca_coordinates'], referenceEntry['ca_residues'], stage_dir) for name, protein in sorted(proteins.items())]
+    start = time.time()
+    prepared = []
+    qualities = {}
+    pool = multiprocessing.Pool(min(ProteinsList.n_procs, max(len(tasks), 1)))
+    try:
+        for name, waters, quality in pool.imap_unordered(prepareChain, tasks):
+            if waters is None:
+                logger.info( '%s could not be prepared in parallel (%s), it is superimposed by PyMOL.' % (name, quality['error']))
+                continue
+            logger.info( 'Superimposing %s (RMSD %.2f over %i of %i C-alpha atoms, %i waters, %.2f s)' % (name,
+                quality['rmsd'], quality['aligned'], quality['ca'], quality['waters'], quality['seconds']))
+            np.savez(os.path.join(stage_dir, 'cwm_%s_Water.npz' % name), **waters)
+            proteins[name].from_arrays = True
+            prepared.append(proteins[name])
+            qualities[name] = quality
+    finally:
+        pool.terminate()
+        pool.join()
+    logger.info( '%i pdb chains prepared in %i processes in %.2f s.' % (len(prepared), ProteinsList.n_procs, time.time() - start))
+    return prepared, qualities
+
+
+CLUSTERING_METHODS = ('complete', 'average', 'single', 'density')
+
+NEIGHBOUR_CELLS = [(dx, dy, dz) for dx in (-1, 0, 1) for dy in (-1, 0, 1) for dz in (-1, 0, 1)]
+
+
+def gridNeighbourhoods( coordinates, cell_size ):
+    """
+        Hash points into a grid of cubic cells of the size cell_size.
+        Returns the cell of every point and, for every occupied cell, the points in the
+        cell and its 26 neighbouring cells as (indptr, points): the neighbourhood of
+        cell c is points[indptr[c]:indptr[c + 1]]. Every point is listed in at most 27
+        neighbourhoods, so time and memory grow linearly with the number of points.
+    """
+    coordinates = np.asarray(coordinates, dtype=float)
+    cells = np.floor(coordinates / cell_size).astype(np.int64)
+    cells -= cells.min(axis=0) - 1
+    dims = cells.max(axis=0) + 2
+    keys = (cells[:, 0] * dims[1] + cells[:, 1]) * dims[2] + cells[:, 2]
+    cellKeys, cell = np.unique(keys, return_inverse=True)
+    order = np.argsort(cell, kind='mergesort')
+    cellStart = np.searchsorted(cell[order], np.arange(len(cellKeys) + 1))
+    owners, points = [], []
+    for dx, dy, dz in NEIGHBOUR_CELLS:
+        neighbourKeys = cellKeys + (dx * dims[1] + dy) * dims[2] + dz
+        position = np.minimum(np.searchsorted(cellKeys, neighbourKeys), len(cellKeys) - 1)
+        found = np.flatnonzero(cellKeys[position] == neighbourKeys)
+        neighbour = position[found]
+        counts = cellStart[neighbour + 1] - cellStart[neighbour]
+        within = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        owners.append(np.repeat(found, counts))
+        points.append(order[np.repeat(cellStart[neighbour], counts) + within])
+    owners = np.concatenate(owners)
+    sort = np.argsort(owners, kind='mergesort')
+    indptr = np.searchsorted(owners[sort], np.arange(len(cellKeys) + 1))
+    return cell.ravel(), indptr, np.concatenate(points)[sort]
+
+
+def densityClusterWaters( water_coordinates, structures, distance ):
+    """
+        Find hydration sites by density peaks, an alternative to hierarchical clustering.
+        The waters are hashed into a grid with cells of the site radius and the density of a water
+        is the number of waters in the neighbourhood of its cell. The site radius is distance * sqrt(3/8),
+        the largest radius needed to enclose waters which are at most distance apart (Jung's theorem).
+        Starting from the densest water, every not yet assigned water opens a new site and takes over
+        unassigned waters within the site radius, nearest first, at most one per structure and only
+        if they are within distance of all waters already in the site, like in complete linkage.
+        This is done once around the water and once more around the centroid of the site.
+        structures gives the index of the structure of every water.
+        Returns cluster numbers like fclusterdata.
+    """
+    coordinates = np.asarray(water_coordinates, dtype=float)
+    structures = np.asarray(structures)
+    radius = distance * np.sqrt(3 / 8.0)
+    cell, indptr, neighbourhood = gridNeighbourhoods(coordinates, radius)
+    density = np.diff(indptr)[cell]
+
+    def growSite(center, candidates):
+        d = np.sqrt(((coordinates[candidates] - center) ** 2).sum(axis=1))
+        close = d <= radius
+        candidates = candidates[close][np.argsort(d[close], kind='mergesort')]
+        points = coordinates[candidates]
+        linked = ((points[:, np.newaxis, :] - points[np.newaxis, :, :]) ** 2).sum(axis=2) <= distance ** 2
+        free = np.ones(len(candidates), dtype=bool)
+        members = []
+        while free.any():
+            nearest = np.argmax(free)
+            members.append(nearest)
+            free &= linked[nearest] & (structures[candidates] != structures[candidates[nearest]])
+        return candidates[members]
+
+    labels = np.zeros(len(structures), dtype=int)
+    cluster = 0
+    for center in np.argsort(-density, kind='mergesort'):
+        if labels[center]:
+            continue
+        candidates = neighbourhood[indptr[cell[center]]:indptr[cell[center] + 1]]
+        candidates = candidates[labels[candidates] == 0]
+        members = growSite(coordinates[center], candidates)
+        if len(members) > 1:
+            shifted = growSite(coordinates[members].mean(axis=0), candidates)
+            if np.any(shifted == center):
+                members = shifted
+        cluster += 1
+        labels[members] = cluster
+    return labels
+
+
+def clusterWaters( water_coordinates, water_ids, method, distance ):
+    """
+        Cluster superimposed water coordinates and return a cluster number for every water.
+        Available methods are: single, complete, average (hierarchical clustering)
+        and density (see densityClusterWaters).
+    """
+    if method == 'density':
+        structures = np.unique([water_id[:6] for water_id in water_ids], return_inverse=True)[1]
+        return densityClusterWaters(water_coordinates, structures, distance)
+    return hcluster.fclusterdata(water_coordinates,
+            t = distance,
+            criterion='distance',
+            metric='euclidean',
+            depth=2,
+            method= method
+        )
+
+
+class ClusterPresence():
+    """
+        Which protein has which water molecule in which cluster.
+        Waters of a protein with more than one water in the same cluster are removed
+        from that cluster, which reduces its degree of conservation.
+        Clusters are indexed in the order of their sorted cluster numbers.
+    """
+    def __init__(self, water_ids, cluster_numbers, proteins):
+        self.proteins = [str(protein) for protein in proteins]
+        self.water_ids = list(water_ids)
+        proteinNumbers = dict((protein, number) for number, protein in enumerate(self.proteins))
+        protein_index = np.array([proteinNumbers[water_id[:6]] for water_id in self.water_ids], dtype=np.int64)
+        self.cluster_numbers, cluster_index = np.unique(cluster_numbers, return_inverse=True)
+        pairs = cluster_index.astype(np.int64) * len(self.proteins) + protein_index
+        inverse, counts = np.unique(pairs, return_inverse=True, return_counts=True)[1:]
+        water_index = np.flatnonzero(counts[inverse] == 1)
+        water_index = water_index[np.argsort(pairs[water_index], kind='mergesort')]
+        self.water_index = water_index
+        self.cluster_index = cluster_index[water_index]
+        self.protein_index = protein_index[water_index]
+        self.indptr = np.searchsorted(self.cluster_index, np.arange(len(self.cluster_numbers) + 1))
+        self.degree = np.diff(self.indptr) / float(len(self.proteins))
+
+    def __len__(self):
+        return len(self.cluster_numbers)
+
+    def water_number(self, water_index):
+        return self.water_ids[water_index][7:]
+
+    def matrix(self, clusters):
+        """
+            Index of the water of every protein (-1 for no water) in each of the given clusters.
+        """
+        table = -np.ones((len(clusters), len(self.proteins)), dtype=np.int64)
+        for row, cluster in enumerate(clusters):
+            start, end = self.indptr[cluster], self.indptr[cluster + 1]
+            table[row, self.protein_index[start:end]] = self.water_index[start:end]
+        return table
+
+
+def writeClusterPresence( handle, presence, clusters, table ):
+    """
+        Write the degree of conservation and the water numbers of every protein for the given clusters.
+    """
+    handle.write('Water Conservation Score'+'\t')
+    for protein in presence.proteins:
+        handle.write('%s' % protein +'\t')
+    handle.write('\n')
+    for cluster, row in zip(clusters, table):
+        handle.write(str(float(presence.degree[cluster]))+'\t')
+        for water in row:
+            if water < 0:
+                handle.write('NoWater'+'\t')
+            else:
+                handle.write(presence.water_number(water)+'\t')
+        handle.write('\n')
+
+
+def loadSuperimposedWaters( sup_dir ):
+    """
+        Water coordinates and ids of all superimposed chains (cwm_xxxx_x.pdb) saved in a result folder.
+    """
+    water_coordinates = []
+    water_ids = []
+    proteins = []
+    for path in sorted(glob.glob(os.path.join(sup_dir, 'cwm_????_?.pdb'))):
+        name = os.path.basename(path)[4:10]
+        protein = Protein(name[:4], name[5])
+        for record in parseChainsFromPDB(path).values():
+            protein.set_water_coordinates(record['water_coordinates'], record['water_serials'])
+        proteins.append(protein)
+        water_coordinates += protein.water_coordinates
+        water_ids += protein.water_ids
+    return water_coordinates, water_ids, proteins
+
+
+def adjustedRandIndex( labels, other ):
+    """
+        Adjusted Rand index of two flat clusterings.
+    """
+    def pairs(counts):
+        counts = np.asarray(counts, dtype=float)
+        return (counts * (counts - 1) / 2.0).sum()
+    both = pairs(np.unique(np.stack((labels, other)), axis=1, return_counts=True)[1])
+    first = pairs(np.unique(labels, return_counts=True)[1])
+    second = pairs(np.unique(other, return_counts=True)[1])
+    expected = first * second / pairs([len(labels)])
+    maximum = (first + second) / 2.0
+    if maximum == expected:
+        return 1.0
+    return (both - expected) / (maximum - expected)
+
+
+def compareClusteringMethods( sup_dir, selectedPDBChain, distance = 2.4, prob = 0.7, method = 'density', reference = 'complete' ):
+    """
+        Compare the conserved waters of selectedPDBChain found by method and by reference
+        on the superimposed chains of a result folder (e.g. a Benchmark family).
+    """
+    water_coordinates, water_ids, proteins = loadSuperimposedWaters(sup_dir)
+    selectedPDBChain = str(selectedPDBChain)
+    results = {}
+    labels = {}
+    for name in (reference, method):
+        labels[name] = clusterWaters(water_coordinates, water_ids, name, distance)
+        presence = ClusterPresence(water_ids, labels[name], proteins)
+        conserved = np.flatnonzero(presence.degree >= prob)
+        query = presence.proteins.index(selectedPDBChain)
+        results[name] = dict((presence.water_number(row[query]), presence.degree[cluster])
+            for cluster, row in zip(conserved, presence.matrix(conserved)) if row[query] >= 0)
+    common = set(results[method]) & set(results[reference])
+    union = set(results[method]) | set(results[reference])
+    comparison = {
+        'proteins': len(proteins),
+        'waters': len(water_ids),
+        'conserved': len(results[method]),
+        'conserved_reference': len(results[reference]),
+        'jaccard': len(common) / float(len(union)) if union else 1.0,
+        'doc_difference': np.mean([abs(results[method][w] - results[reference][w]) for w in common]) if common else 0.0,
+        'ari': adjustedRandIndex(labels[reference], labels[method]),
+    }
+    return comparison
+
+
+def benchmarkClusteringAgreement( benchmark_dir, distance = 2.4, prob = 0.7, method = 'density', reference = 'complete' ):
+    """
+        Report the agreement of a clustering method with the reference linkage method on
+        every Benchmark family folder, named after the query chain and its degree of conservation
+        cutoff, e.g. 1axb_a_0.8 (prob if not given). Folders of the same query hold the same chains,
+        so every query is compared once, on the folder without cutoff if there is one.
+    """
+    distance = float(distance)
+    prob = float(prob)
+    families = collections.OrderedDict()
+    for sup_dir in sorted(glob.glob(os.path.join(benchmark_dir, '*', '*'))):
+        name = os.path.basename(sup_dir)
+        if not os.path.isdir(sup_dir) or not os.path.exists(os.path.join(sup_dir, 'cwm_%s.pdb' % name[:6])):
+            continue
+        family = os.path.join(os.path.basename(os.path.dirname(sup_dir)), name[:6])
+        if family not in families or len(name) == 6:
+            families[family] = (sup_dir, float(name[7:]) if len(name) > 7 else prob)
+    comparisons = {}
+    logger.info( 'Family\tcutoff\tchains\twaters\tconserved %s\tconserved %s\tJaccard\tmean DOC difference\tARI' % (reference, method))
+    for family, (sup_dir, cutoff) in families.items():
+        name = os.path.basename(sup_dir)
+        c = compareClusteringMethods(sup_dir, Protein(name[:4], name[5]), distance, cutoff, method, reference)
+        c['prob'] = cutoff
+        comparisons[family] = c
+        logger.info( '%s\t%s\t%i\t%i\t%i\t%i\t%.3f\t%.3f\t%.3f' % (family, cutoff,
+            c['proteins'], c['waters'], c['conserved_reference'], c['conserved'], c['jaccard'], c['doc_difference'], c['ari']))
+    return comparisons
+
+
+def makeSyntheticWaters( n_chains, n_waters, conservation = 0.7, noise = 0.3, seed = 0 ):
+    """
+        Synthetic superimposed chains for benchmarking without PyMOL or network access.
+        n_waters hydration sites are placed on a jittered 3 A lattice. Every chain has
+        n_waters waters: each site is occupied with the probability conservation (with
+        gaussian positional noise in A) and the remaining waters are placed randomly.
+        Returns water coordinates (numpy array), water ids and proteins.
+    """
+    random = np.random.RandomState(seed)
+    side = int(np.ceil(n_waters ** (1.0 / 3)))
+    lattice = np.indices((side, side, side)).reshape(3, -1).T * 3.0
+    sites = lattice[random.permutation(len(lattice))[:n_waters]] + random.uniform(-0.3, 0.3, (n_waters, 3))
+    box = side * 3.0
+    proteins = [Protein('%04d' % number, 'A') for number in xrange(n_chains)]
+    water_coordinates = []
+    water_ids = []
+    for protein in proteins:
+        occupied = random.uniform(size=n_waters) < conservation
+        coordinates = np.where(occupied[:, np.newaxis],
+            sites + random.normal(0.0, noise, (n_waters, 3)),
+            random.uniform(0.0, box, (n_waters, 3)))
+        water_coordinates.append(coordinates)
+        water_ids += ['%s_%s' % (protein, serial) for serial in xrange(1, n_waters + 1)]
+    return np.concatenate(water_coordinates), water_ids, proteins
+
+
+def measureStage( function, *args ):
+    """
+        Run function(*args) and return its result, the elapsed time in seconds and the peak of the
+        memory allocated by the stage in MB (traced from its start).
+    """
+    if tracemalloc is not None:
+        tracemalloc.start()
+    start = time.time()
+    result = function(*args)
+    elapsed = time.time() - start
+    peak = float('nan')
+    if tracemalloc is not None:
+        peak = tracemalloc.get_traced_memory()[1] / 1048576.0
+        tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def extractConservedClusters( water_ids, cluster_numbers, proteins, probability, clusterPresenceOut ):
+    """
+        Find the clusters with a degree of conservation >= probability and write their presence table.
+        Returns the ClusterPresence, the indices of the conserved clusters and their presence table.
+    """
+    presence = ClusterPresence(water_ids, cluster_numbers, proteins)
+    conserved = np.flatnonzero(presence.degree >= probability)
+    table = presence.matrix(conserved)
+    writeClusterPresence(clusterPresenceOut, presence, conserved, table)
+    return presence, conserved, table
+
+
+CONFIDENCE_METHODS = ('bootstrap', 'jackknife')
+
+
+def conservationIntervals( occupied, method = 'bootstrap', probability = 0.7, resamples = 1000, seed = 0 ):
+    """
+        Confidence of the degrees of conservation of clusters by resampling the member chains,
+        computed on the boolean cluster x protein presence matrix occupied without re-clustering.
+        bootstrap: the chains are drawn with replacement resamples times, as multinomial weights, so all
+        degrees of all resamples are one matrix product. Returns the 95 % percentile interval and the
+        stability, the fraction of resamples in which a cluster reaches probability.
+        jackknife: every chain is left out once. Returns the standard error and the normal 95 % interval.
+    """
+    occupied = np.asarray(occupied, dtype=float)
+    n_proteins = occupied.shape[1]
+    degree = occupied.sum(axis=1) / n_proteins
+    intervals = {'degree': degree}
+    if method == 'jackknife':
+        leaveOneOut = (occupied.sum(axis=1)[:, None] - occupied) / (n_proteins - 1.0)
+        error = np.sqrt((n_proteins - 1.0) / n_proteins * ((leaveOneOut - leaveOneOut.mean(axis=1)[:, None]) ** 2).sum(axis=1))
+        intervals['standard_error'] = error
+        intervals['lower'] = np.clip(degree - 1.96 * error, 0, 1)
+        intervals['upper'] = np.clip(degree + 1.96 * error, 0, 1)
+    else:
+        weights = np.random.RandomState(seed).multinomial(n_proteins, np.ones(n_proteins) / n_proteins, size=int(resamples))
+        degrees = np.dot(occupied, weights.T.astype(float)) / n_proteins
+        intervals['lower'], intervals['upper'] = np.percentile(degrees, [2.5, 97.5], axis=1)
+        intervals['stability'] = (degrees >= probability - 1e-9).mean(axis=1)
+    return intervals
+
+
+def writeConservationIntervals( handle, presence, clusters, query, intervals, conserved ):
+    """
+        Write the degree of conservation and its confidence interval for the query water of every cluster.
+    """
+    method = 'stability' if 'stability' in intervals else 'standard error'
+    handle.write('water number\tdegree of conservation\tlower 95%% bound\tupper 95%% bound\t%s\tconserved\n' % method)
+    table = presence.matrix(clusters)
+    conserved = set(conserved)
+    for row, cluster in enumerate(clusters):
+        handle.write('%s\t%.3f\t%.3f\t%.3f\t%.3f\t%s\n' % (presence.water_number(table[row, query]), intervals['degree'][row],
+            intervals['lower'][row], intervals['upper'][row], intervals['stability' if 'stability' in intervals else 'standard_error'][row],
+            'yes' if cluster in conserved else 'no'))
+
+
+def writeFamilySites( path, presence, water_coordinates, reference_pdb, ProteinsList ):
+    """
+        Save the hydration sites of a family for transferConservedWaters: the centroid, spread (RMS
+        distance of its waters from the centroid), degree of conservation and query water of every
+        cluster, and the C-alpha trace of the query in the frame of the superimposed family.
+    """
+    selectedPDBChain = str(ProteinsList.selectedPDBChain)
+    if selectedPDBChain not in presence.proteins or not os.path.exists(reference_pdb):
+        logger.info( '%s is not among the superimposed chains, the hydration sites are not saved.' % selectedPDBChain)
+        return
+    reference = parseChainsFromPDB(reference_pdb, [ProteinsList.selectedPDBChain.chain]).get(ProteinsList.selectedPDBChain.chain)
+    if reference is None:
+        logger.warning( 'No C-alpha trace of %s, the hydration sites are not saved.' % selectedPDBChain)
+        return
+    counts = np.diff(presence.indptr)
+    coordinates = np.asarray(water_coordinates, dtype=float)[presence.water_index]
+    centroids = np.array([np.bincount(presence.cluster_index, coordinates[:, axis], minlength=len(presence))
+        for axis in xrange(3)]).T.reshape(-1, 3) / np.maximum(counts, 1)[:, None]
+    spreads = np.sqrt(np.bincount(presence.cluster_index, ((coordinates - centroids[presence.cluster_index]) ** 2).sum(axis=1),
+        minlength=len(presence)) / np.maximum(counts, 1))
+    query_waters = -np.ones(len(presence), dtype=np.int64)
+    query = presence.protein_index == presence.proteins.index(selectedPDBChain)
+    query_waters[presence.cluster_index[query]] = [int(presence.water_number(index)) for index in presence.water_index[query]]
+    occupied = counts > 0
+    np.savez(path, centroids = centroids[occupied], spreads = spreads[occupied], degrees = presence.degree[occupied],
+        query_waters = query_waters[occupied], ca_coordinates = reference['ca_coordinates'], ca_residues = reference['ca_residues'],
+        query = selectedPDBChain, n_proteins = len(presence.proteins), distance = float(ProteinsList.inconsistency_coefficient),
+        probability = float(ProteinsList.probability), clustering_method = ProteinsList.clustering_method)
+
+
+def scalingExponent( sizes, values ):
+    """
+        Slope of log(values) against log(sizes), e.g. 1 for linear and 2 for quadratic growth.
+    """
+    sizes = np.asarray(sizes, dtype=float)
+    values = np.asarray(values, dtype=float)
+    usable = (values > 0) & np.isfinite(values)
+    if len(np.unique(sizes[usable])) < 2:
+        return float('nan')
+    return np.polyfit(np.log(sizes[usable]), np.log(values[usable]), 1)[0]
+
+
+def benchmarkScaling( chains = '10,20,40', waters = '100,200,400', methods = 'complete,average,single,density',
+        baseline = '', report = '', record = False, tolerance = 0.3, distance = 2.4, probability = 0.7,
+        conservation = 0.7, noise = 0.3, max_waters = 50000 ):
+    """
+        Measure time and peak memory of the clustering and extraction stages on synthetic data
+        for every combination of chains x waters per chain and every clustering method.
+        Writes a tab separated report and the scaling exponents (log-log slope against the total
+        number of waters) of every method and stage. If a baseline file exists, the run fails when an
+        exponent exceeds the recorded one by more than tolerance; with record (or without an existing
+        baseline file) the exponents are recorded as the new baseline.
+        Returns True if the scaling is within the baseline, raises RuntimeError otherwise.
+    """
+    if not isinstance(chains, (list, tuple)):
+        chains = [int(n) for n in str(chains).split(',')]
+    if not isinstance(waters, (list, tuple)):
+        waters = [int(m) for m in str(waters).split(',')]
+    if not isinstance(methods, (list, tuple)):
+        methods = [method.strip() for method in str(methods).split(',')]
+    record = str(record).lower() in ('1', 'true', 'yes')
+    tolerance = float(tolerance)
+    distance = float(distance)
+    probability = float(probability)
+    report = report or os.path.join(outdir, 'pywater_scaling.tsv')
+    stages = ('cluster', 'extract')
+    rows = []
+    for method in methods:
+        for n_chains in chains:
+            for n_waters in waters:
+                total = n_chains * n_waters
+                if method != 'density' and total >= int(max_waters):
+                    logger.info( 'Skipping %s for %i x %i waters, above the limit of %s waters.' % (method, n_chains, n_waters, max_waters))
+                    continue
+                water_coordinates, water_ids, proteins = makeSyntheticWaters(n_chains, n_waters, float(conservation), float(noise))
+                labels, seconds, peak = measureStage(clusterWaters, water_coordinates, water_ids, method, distance)
+                rows.append((method, n_chains, n_waters, total, 'cluster', seconds, peak))
+                devnull = open(os.devnull, 'w')
+                result, seconds, peak = measureStage(extractConservedClusters, water_ids, labels, proteins, probability, devnull)
+                devnull.close()
+                rows.append((method, n_chains, n_waters, total, 'extract', seconds, peak))
+                logger.info( '%s: %i chains x %i waters: clustering %.3f s, extraction %.3f s' % (method, n_chains, n_waters, rows[-2][5], rows[-1][5]))
+
+    exponents = {}
+    for method in methods:
+        for stage in stages:
+            selected = [row for row in rows if row[0] == method and row[4] == stage]
+            exponents['%s/%s/time' % (method, stage)] = scalingExponent([row[3] for row in selected], [row[5] for row in selected])
+            exponents['%s/%s/memory' % (method, stage)] = scalingExponent([row[3] for row in selected], [row[6] for row in selected])
+
+    reportOut = open(report, 'w')
+    reportOut.write('method\tchains\twaters per chain\twaters\tstage\tseconds\tpeak traced MB\n')
+    for row in rows:
+        reportOut.write('%s\t%i\t%i\t%i\t%s\t%.4f\t%.2f\n' % row)
+    reportOut.write('\nscaling exponent\tvalue\tbaseline\n')
+
+    recorded = {}
+    if baseline and os.path.exists(baseline) and not record:
+        recorded = json.load(open(baseline))
+    exceeded = []
+    for key in sorted(exponents):
+        value = exponents[key]
+        reference = recorded.get(key)
+        reportOut.write('%s\t%.3f\t%s\n' % (key, value, '' if reference is None else '%.3f' % reference))
+        logger.info( 'Scaling exponent %s: %.3f (baseline: %s)' % (key, value, reference))
+        if reference is not None and np.isfinite(value) and value > reference + tolerance:
+            logger.error( 'Scaling exponent %s of %.3f exceeds the baseline %.3f.' % (key, value, reference))
+            exceeded.append(key)
+    reportOut.close()
+    logger.info( 'Scaling report is saved in %s' % report)
+    if baseline and (record or not os.path.exists(baseline)):
+        with open(baseline, 'w') as handle:
+            json.dump(dict((key, value) for key, value in exponents.items() if np.isfinite(value)), handle, indent=1, sort_keys=True)
+        logger.info( 'Scaling baseline is recorded in %s' % baseline)
+    if exceeded:
+        # fail the CI job running the benchmark
+        raise RuntimeError('Scaling exponents exceed the baseline %s: %s' % (baseline, ', '.join(exceeded)))
+    return True
+
+
+def queryReachableWaters( water_coordinates, anchors, distance, closure = False ):
+    """
+        Query-anchored pruning: only clusters with a water of the query chain are used, so waters
+        farther than distance from every anchor (query) water can not take part in them.
+        Returns a boolean mask of the waters within distance of an anchor water, found with a KD-tree
+        over the anchor waters. With closure the mask is extended to everything connected to the
+        anchors by steps shorter than distance, which keeps single linkage clusters of the anchors exact.
+    """
+    coordinates = np.asarray(water_coordinates, dtype=float)
+    keep = np.zeros(len(coordinates), dtype=bool)
+    if len(anchors) == 0:
+        return keep
+    keep[anchors] = True
+    nearest = cKDTree(coordinates[anchors]).query(coordinates, distance_upper_bound=distance)[0]
+    frontier = np.flatnonzero(np.isfinite(nearest) & ~keep)
+    keep[frontier] = True
+    if closure:
+        tree = cKDTree(coordinates)
+        while len(frontier):
+            reached = np.unique(np.concatenate([np.asarray(neighbours, dtype=int) for neighbours in
+                tree.query_ball_point(coordinates[frontier], distance)]))
+            frontier = reached[~keep[reached]]
+            keep[frontier] = True
+    return keep
+
+
+def addRemark( pdbFile, remark ):
+    """
+        Insert a free text REMARK at the top of a PDB file.
+    """
+    lines = open(pdbFile).readlines()
+    with open(pdbFile, 'w') as handle:
+        handle.write('REMARK 999 %s\n' % remark)
+        handle.write(''.join(lines))
+
+
+def refinedWaterCoordinates( proteins, refinement_dir ):
+    """
+        Superimposed water oxygen coordinates of all proteins kept by the refinement filter, as one array.
+    """
+    coordinates = [np.zeros((0, 3))]
+    for protein in proteins:
+        if protein.from_arrays:
+            coordinates.append(np.load(os.path.join(refinement_dir, 'cwm_%s_Water.npz' % protein))['water_coordinates'])
+        else:
+            coordinates.append(np.array([[float(line[30:38]), float(line[38:46]), float(line[46:54])]
+                for line in open(os.path.join(refinement_dir, 'cwm_%s_Water.pdb' % protein)) if line.startswith('HETATM')]).reshape(-1, 3))
+    return np.concatenate(coordinates).astype(float)
+
+
+def waterDensityMap( coordinates, n_proteins, spacing = 0.5, lower = None, upper = None, sigma = 0.8 ):
+    """
+        Occupancy grid of the water oxygen coordinates of n_proteins superimposed structures between
+        the lower and upper corner (default: all waters with a margin of 3 sigma), smoothed by a
+        gaussian of sigma A. It is scaled so that a site with a water at the same position in every
+        structure has a density of 1. The grid points are multiples of spacing.
+        Returns the density (x, y, z) and the index of its first grid point.
+    """
+    coordinates = np.asarray(coordinates, dtype=float).reshape(-1, 3)
+    if lower is None:
+        lower = coordinates.min(axis=0) - 3 * sigma
+    if upper is None:
+        upper = coordinates.max(axis=0) + 3 * sigma
+    start = np.floor(np.asarray(lower) / spacing).astype(int)
+    shape = np.ceil(np.asarray(upper) / spacing).astype(int) - start + 1
+    edges = [(start[axis] + np.arange(shape[axis] + 1) - 0.5) * spacing for axis in xrange(3)]
+    counts = np.histogramdd(coordinates, bins=edges)[0]
+    # the peak of a single smoothed water, to scale the density to a degree of conservation
+    width = int(np.ceil(4 * sigma / spacing))
+    delta = np.zeros((2 * width + 1,) * 3)
+    delta[width, width, width] = 1.0
+    peak = ndimage.gaussian_filter(delta, sigma / spacing).max()
+    density = ndimage.gaussian_filter(counts, sigma / spacing) / (peak * n_proteins)
+    return density.astype(np.float32), start
+
+
+def writeCCP4Map( path, density, start, spacing ):
+    """
+        Write a density grid (x, y, z) starting at grid index start as a CCP4/MRC map (mode 2, little endian).
+    """
+    nx, ny, nz = density.shape
+    header = struct.pack('<10i6f3i3f2i', nx, ny, nz, 2, start[0], start[1], start[2], nx, ny, nz,
+        nx * spacing, ny * spacing, nz * spacing, 90.0, 90.0, 90.0, 1, 2, 3,
+        float(density.min()), float(density.max()), float(density.mean()), 1, 0)
+    header += b'\0' * (4 * 25) + struct.pack('<3f', 0.0, 0.0, 0.0)
+    header += b'MAP ' + b'\x44\x41\x00\x00' + struct.pack('<fi', float(density.std()), 1)
+    header += b'PyWATER water oxygen density'.ljust(800, b' ')
+    handle = open(path, 'wb')
+    handle.write(header)
+    # sections along z, rows along y, columns along x
+    handle.write(np.ascontiguousarray(density.transpose(2, 1, 0), dtype='<f4').tobytes())
+    handle.close()
+
+
+# PyMOL has a single global session: the jobs of the service take turns in using it
+PYMOL_LOCK = threading.RLock()
+
+
+class StageCache():
+    """
+        Stage-level checkpoints of a run. Every stage saves its artifacts in work_dir/<stage>/<key>,
+        where key is a hash of the stage name, its parameters and the keys of the stages it depends on.
+        A re-run reuses every stage whose inputs did not change and recomputes only the stages
+        downstream of a changed parameter. Results are also kept in the dictionary memory, if given,
+        which can be shared by the caches of several runs. The stages in the dictionary expiry are
+        recomputed, with their downstream stages, after expiry[stage] seconds.
+    """
+    def __init__(self, work_dir, memory = None, expiry = None):
+        self.work_dir = work_dir
+        self.memory = memory
+        self.expiry = expiry or {}
+        self.reused = []
+        self.computed = []
+
+    def key(self, stage, parameters, upstream = ''):
+        return hashlib.sha1(json.dumps([stage, parameters, upstream], sort_keys=True).encode('utf-8')).hexdigest()[:16]
 
-    cmd.delete('cwm_*')
+    def run(self, stage, parameters, upstream, compute):
+        """
+            Returns the key, result and directory of a stage. compute(stage_dir) saves the artifacts
+            of the stage in stage_dir and returns a JSON serializable result. It is only called if the
+            stage has no checkpoint yet, and the checkpoint only appears once the stage is complete.
+        """
+        if stage in self.expiry:
+            # a new key for every period of expiry[stage] seconds
+            parameters = dict(parameters, period=int(time.time() // self.expiry[stage]))
+        key = self.key(stage, parameters, upstream)
+        stage_dir = os.path.join(self.work_dir, stage, key)
+        checkpoint = os.path.join(stage_dir, 'stage.json')
+        if os.path.exists(checkpoint):
+            logger.info( 'Reusing the %s stage from %s' % (stage, stage_dir))
+            self.reused.append(stage)
+            if self.memory is None:
+                return key, json.load(open(checkpoint))['result'], stage_dir
+            # may be dropped from the memory by another thread
+            result = self.memory.get(stage_dir)
+            if result is None:
+                result = self.memory[stage_dir] = json.load(open(checkpoint))['result']
+            return key, copy.deepcopy(result), stage_dir
+        # threads of one process (the jobs of the service) may compute the same stage
+        tmp_dir = '%s.%s-%s-%s.tmp' % (stage_dir, socket.gethostname(), os.getpid(), threading.current_thread().ident)
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+        try:
+            result = compute(tmp_dir)
+            with open(os.path.join(tmp_dir, 'stage.json'), 'w') as handle:
+                json.dump({'stage': stage, 'parameters': parameters, 'upstream': upstream, 'result': result},
+                    handle, indent=1, sort_keys=True)
+        except:
+            shutil.rmtree(tmp_dir)
+            raise
+        try:
+            os.rename(tmp_dir, stage_dir)
+        except OSError:
+            # another run finished the same stage first, its artifacts are identical
+            shutil.rmtree(tmp_dir)
+        self.computed.append(stage)
+        if self.memory is not None:
+            self.memory[stage_dir] = copy.deepcopy(result)
+        return key, result, stage_dir
+
+    def report(self):
+        logger.info( 'Reused stages: %s; recomputed stages: %s' % (', '.join(self.reused) or 'none', ', '.join(self.computed) or 'none'))
+        return self.reused, self.computed
+
+
+def makePDBwithConservedWaters(ProteinsList, temp_dir, outdir, save_sup_files, display=True, cache=None, upstream=''):
+    """
+        Superimpose, filter and cluster the waters of all chains in ProteinsList and save the query
+        structure with its conserved waters in outdir. Returns a dictionary of the conserved
+        water numbers of the query and their degree of conservation.
+        The downloads, superposition, refinement, clustering and extraction stages are checkpointed
+        in the StageCache cache (temp_dir if not given); upstream is the key of the stage that
+        produced ProteinsList.
+    """
+    logger.info( 'Minimum desired degree of conservation is : %s' % ProteinsList.probability )
+    cache = cache or StageCache(temp_dir)
+    selectedPDBChain = str(ProteinsList.selectedPDBChain)
+    atlas_dir = ProteinsList.atlas.atlas_dir if ProteinsList.atlas is not None else ''
+
+    def downloads(stage_dir):
+        # chains found in the water atlas do not need their structure, unless they fall back to PyMOL
+        pdb_ids = []
+        for protein in ProteinsList:
+            if ProteinsList.atlas is None or str(protein) not in ProteinsList.atlas or str(protein) in (str(ProteinsList[0]), selectedPDBChain):
+                if protein.pdb_id not in pdb_ids:
+                    # structures downloaded for another list of chains are copied
+                    downloaded = [path for path in glob.glob(os.path.join(cache.work_dir, 'downloads', '*', protein.pdb_filename))
+                        if os.path.exists(os.path.join(os.path.dirname(path), 'stage.json'))]
+                    if downloaded:
+                        shutil.copy(downloaded[0], stage_dir)
+                    else:
+                        retrieveStructure(protein.pdb_id, stage_dir, ProteinsList.atlas)
+                    pdb_ids.append(protein.pdb_id)
+        return pdb_ids
+    key, pdb_ids, structure_dir = cache.run('downloads',
+        {'proteins': [str(protein) for protein in ProteinsList], 'atlas_dir': atlas_dir}, upstream, downloads)
+
+    def superposition(stage_dir):
+        cmd.delete('cwm_*')
+        atlasProteins = []
+        if ProteinsList.atlas is not None:
+            logger.info( 'Loading pdb chains from the water atlas ...' )
+            atlasProteins = loadChainsFromAtlas(ProteinsList, structure_dir, stage_dir)
+        parallelProteins, qualities = [], {}
+        if ProteinsList.n_procs > 1:
+            logger.info( 'Preparing pdb chains in %i processes ...' % ProteinsList.n_procs )
+            parallelProteins, qualities = prepareChainsInParallel(ProteinsList, structure_dir, stage_dir)
+        pymolProteins = [protein for protein in ProteinsList if not protein.from_arrays]
+
+        logger.info( 'Loading all pdb chains ...' )
+        for protein in pymolProteins:
+            cmd.load(structurePath(protein.pdb_id, structure_dir, stage_dir, ProteinsList.atlas),'cwm_%s' % protein.pdb_id)
+            cmd.remove('(hydro) and cwm_%s' % protein.pdb_id)
+            cmd.select('dods','resn dod')
+            cmd.alter('dods', 'resn="HOH"')
+            cmd.create('cwm_%s' % protein, 'cwm_%s & chain %s' % (protein.pdb_id, protein.chain))
+            cmd.delete( 'cwm_%s' % protein.pdb_id )
+
+        logger.info( 'Superimposing all pdb chains ...' )
+        for protein in pymolProteins[1:]:
+            logger.info( 'Superimposing %s' % protein )
+            cmd.super('cwm_%s////CA' % protein, 'cwm_%s////CA' % ProteinsList[0])
+            cmd.orient( 'cwm_%s' % ProteinsList[0] )
+
+        anchors = None
+        if ProteinsList.anchor_selection:
+            anchors = set()
+            cmd.iterate('cwm_%s & resname hoh & (%s)' % (selectedPDBChain, ProteinsList.anchor_selection),
+                'anchors.add(int(resv))', space={'anchors': anchors})
+            logger.info( '%i water molecules of %s are in the anchor selection "%s".' % (len(anchors), selectedPDBChain, ProteinsList.anchor_selection))
+            anchors = sorted(anchors)
+
+        logger.info( 'Creating new, water only, pymol objects for each pdb chain ...' )
+        for protein in pymolProteins:
+            cmd.create('cwm_%s_Water' % protein, 'cwm_%s & resname hoh' % protein)
+
+        logger.info( 'Storing water molecules and proteins in separate pdb files for each pdb chain ...' )
+        for protein in pymolProteins:
+            cmd.save(os.path.join(stage_dir, 'cwm_%s.pdb' % protein), 'cwm_%s' % protein)
+            cmd.save(os.path.join(stage_dir, 'cwm_%s_Water.pdb' % protein), 'cwm_%s_Water' % protein)
+
+        cmd.delete('cwm_*')
+        # structures retrieved as a fallback are not needed downstream
+        for path in glob.glob(os.path.join(stage_dir, '????.pdb')):
+            os.remove(path)
+        return {'atlas': [str(protein) for protein in atlasProteins], 'parallel': [str(protein) for protein in parallelProteins],
+            'quality': qualities, 'anchor_waters': anchors}
+    # chains prepared in parallel are superimposed on matched residue numbers instead of by cmd.super
+    with PYMOL_LOCK:
+        key, superposed, superposition_dir = cache.run('superposition',
+            {'atlas_dir': atlas_dir, 'anchor_selection': ProteinsList.anchor_selection, 'parallel': ProteinsList.n_procs > 1}, key, superposition)
+    for protein in ProteinsList:
+        protein.from_arrays = str(protein) in superposed['atlas'] or str(protein) in superposed['parallel']
+    if superposed['anchor_waters'] is not None:
+        ProteinsList.anchor_waters = set(superposed['anchor_waters'])
 
     ### filter ProteinsList by mobility or normalized B factor cutoff
-    logger.debug( 'Protein chains list is %s proteins long.' % len(ProteinsList.proteins) )
-    if ProteinsList.refinement != 'No refinement':
-        length = len(ProteinsList.proteins)
+    def refinement(stage_dir):
+        logger.debug( 'Protein chains list is %s proteins long.' % len(ProteinsList.proteins) )
         if ProteinsList.refinement == 'Mobility':
             logger.info( 'Filtering water oxygen atoms by mobility ...' )
-            for protein in reversed(ProteinsList.proteins):
-                if str(protein) != str(ProteinsList.selectedPDBChain):
-                    if not okMobility(os.path.join(temp_dir, 'cwm_%s_Water.pdb' % protein)):
-                        ProteinsList.proteins.remove(protein)
-
-        if ProteinsList.refinement == 'Normalized B-factor': 
+        if ProteinsList.refinement == 'Normalized B-factor':
             logger.info( 'Filtering water oxygen atoms by Normalized B-factor' )
-            for protein in reversed(ProteinsList.proteins):
-                if str(protein) != str(ProteinsList.selectedPDBChain):
-                    if not okBfactor(os.path.join(temp_dir, 'cwm_%s_Water.pdb' % protein)):
-                        ProteinsList.proteins.remove(protein)
-
-        logger.debug( 'filtered proteins chains list is %s proteins long :' % len(ProteinsList.proteins) )
+        kept = []
+        for protein in ProteinsList:
+            filtered = str(protein) != selectedPDBChain and ProteinsList.refinement != 'No refinement'
+            if protein.from_arrays:
+                waters = dict(np.load(os.path.join(superposition_dir, 'cwm_%s_Water.npz' % protein)))
+                if filtered:
+                    keep = refinementMask(waters['bfactors'], waters['occupancies'], ProteinsList.refinement)
+                    if keep is None:
+                        logger.info( '%s is excluded from the prediction.' % protein)
+                        continue
+                    waters = dict((name, array[keep]) for name, array in waters.items())
+                np.savez(os.path.join(stage_dir, 'cwm_%s_Water.npz' % protein), **waters)
+            else:
+                path = os.path.join(stage_dir, 'cwm_%s_Water.pdb' % protein)
+                shutil.copy(os.path.join(superposition_dir, 'cwm_%s_Water.pdb' % protein), path)
+                if filtered and ProteinsList.refinement == 'Mobility' and not okMobility(path):
+                    continue
+                if filtered and ProteinsList.refinement == 'Normalized B-factor' and not okBfactor(path):
+                    continue
+            kept.append(str(protein))
+        logger.debug( 'filtered proteins chains list is %s proteins long :' % len(kept) )
+        return kept
+    key, kept, refinement_dir = cache.run('refinement', {'refinement': ProteinsList.refinement}, key, refinement)
+    ProteinsList.proteins = [protein for protein in ProteinsList if str(protein) in kept]
 
     """ 
         Filtered ProteinsList
     """
 
-    selectedPDBChain = str(ProteinsList.selectedPDBChain)
     if not os.path.exists(os.path.join(outdir,selectedPDBChain)):
         os.mkdir(os.path.join(outdir,selectedPDBChain))
 
     if save_sup_files:
-        for file in glob.glob(os.path.join(temp_dir, 'cwm_????_?.pdb')):
+        for file in glob.glob(os.path.join(superposition_dir, 'cwm_????_?.pdb')):
             shutil.copy(file, os.path.join(outdir,selectedPDBChain))
+        if superposed['atlas']:
+            logger.info( 'Superimposed files are not saved for chains loaded from the water atlas.' )
 
     # Only if ProteinsList has more than one protein
-    if len(ProteinsList.proteins) > 1:
+    if len(ProteinsList.proteins) <= 1:
+        logger.error( "%s has only one PDB structure. We need atleast 2 structures to superimpose." % selectedPDBChain )
+        return None
+
+    density_map = None
+    if ProteinsList.map_spacing > 0:
+        def density(stage_dir):
+            coordinates = refinedWaterCoordinates(ProteinsList, refinement_dir)
+            if not len(coordinates):
+                return None
+            lower = upper = None
+            query_pdb = os.path.join(superposition_dir, 'cwm_%s.pdb' % selectedPDBChain)
+            if ProteinsList.map_extent > 0 and not os.path.exists(query_pdb):
+                logger.info( '%s was not superimposed, the water density map covers all waters.' % selectedPDBChain)
+            elif ProteinsList.map_extent > 0:
+                # box around the query chain
+                atoms = np.array([[float(line[30:38]), float(line[38:46]), float(line[46:54])]
+                    for line in open(query_pdb)
+                    if line.startswith(('ATOM', 'HETATM')) and line[17:20] != 'HOH']).reshape(-1, 3)
+                if len(atoms):
+                    lower = atoms.min(axis=0) - ProteinsList.map_extent
+                    upper = atoms.max(axis=0) + ProteinsList.map_extent
+                    inside = np.all((coordinates >= lower) & (coordinates <= upper), axis=1)
+                    coordinates = coordinates[inside]
+            logger.info( 'Computing the water density map of %i water oxygen atoms ...' % len(coordinates))
+            densityMap, start = waterDensityMap(coordinates, len(ProteinsList.proteins), ProteinsList.map_spacing, lower, upper)
+            writeCCP4Map(os.path.join(stage_dir, 'cwm_%s_waterDensity.ccp4' % selectedPDBChain), densityMap, start, ProteinsList.map_spacing)
+            return list(densityMap.shape)
+        # not upstream of clustering, so changing the map does not recompute the clusters
+        density_key, shape, density_dir = cache.run('density', {'spacing': ProteinsList.map_spacing, 'extent': ProteinsList.map_extent}, key, density)
+        if shape:
+            density_map = os.path.join(outdir, selectedPDBChain, 'cwm_%s_waterDensity.ccp4' % selectedPDBChain)
+            shutil.copy(os.path.join(density_dir, 'cwm_%s_waterDensity.ccp4' % selectedPDBChain), density_map)
+            logger.info( 'Water density map (%s grid points, %s A spacing) is saved in %s' % (' x '.join(str(n) for n in shape), ProteinsList.map_spacing, density_map))
+
+    def clustering(stage_dir):
         water_coordinates = list()
-        waterIDCoordinates = {}
         water_ids = list()
         for protein in ProteinsList:
-            protein.calculate_water_coordinates( temp_dir )
+            if protein.from_arrays:
+                waters = np.load(os.path.join(refinement_dir, 'cwm_%s_Water.npz' % protein))
+                protein.set_water_coordinates(waters['water_coordinates'], waters['water_serials'])
+            else:
+                protein.calculate_water_coordinates( refinement_dir )
             logger.debug( 'Protein %s has %i coordinates.' % (protein, len(protein.water_coordinates)))
             water_coordinates += protein.water_coordinates
             water_ids += protein.water_ids
 
-        if water_coordinates:
+        approximate = False
+        if ProteinsList.query_anchored and water_coordinates:
+            # keep only the anchor waters of the query and the waters of other chains which can reach them
+            query = np.array([water_id[:6] == selectedPDBChain for water_id in water_ids])
+            anchors = query.copy()
+            if ProteinsList.anchor_waters is not None:
+                anchors &= np.array([water_id[7:].isdigit() and int(water_id[7:]) in ProteinsList.anchor_waters for water_id in water_ids])
+            keep = queryReachableWaters(water_coordinates, np.flatnonzero(anchors),
+                ProteinsList.inconsistency_coefficient, closure = ProteinsList.clustering_method == 'single')
+            keep &= anchors | ~query
+            logger.info( 'Query-anchored pruning keeps %i of %i water molecules.' % (keep.sum(), len(water_ids)))
+            water_coordinates = [water_coordinates[i] for i in np.flatnonzero(keep)]
+            water_ids = [water_ids[i] for i in np.flatnonzero(keep)]
+            # connected components of single linkage are kept completely, any other clustering can change
+            approximate = ProteinsList.clustering_method != 'single' or ProteinsList.anchor_waters is not None
+            if approximate:
+                logger.warning( 'Query-anchored pruning with %s clustering: the degrees of conservation are approximate.' % ProteinsList.clustering_method)
+
+        if not water_coordinates:
             # Only if there are any water molecules list of similar protein structures.
-            logger.info( 'Number of water molecules to cluster: %i' % len(water_coordinates) )
-            if len(water_coordinates) != 1:
-                # Only if the total number of water molecules to cluster is less than 50000.
-                if len(water_coordinates) < 50000:
-                    cwm_count = 0
-                    logger.info( 'Clustering the water coordinates ...' )
-                    # The clustering returns a list of clusternumbers
-                    # Available optoins are: single, complete, average
-                    FD = hcluster.fclusterdata(water_coordinates, 
-                            t = ProteinsList.inconsistency_coefficient,
-                            criterion='distance', 
-                            metric='euclidean',
-                            depth=2,
-                            method= ProteinsList.clustering_method
-                        )
-                    FDlist = list(FD)
-                    fcDic = {}
-                    for a,b in zip(water_ids,FDlist):
-                        if b in fcDic:
-                            fcDic[b].append(a)
-                        else:
-                            fcDic[b]=[a]
-
-                    conservedWaterDic = {}
-                    clusterPresenceDic = {}
-                    clusterPresenceOut = open(os.path.join( outdir, selectedPDBChain, '%s_clusterPresence.txt' % selectedPDBChain ),'w')
-                    clusterPresenceOut.write('Water Conservation Score'+'\t')
-                    proteins_numbers = {}
-                    l=0
-                    for i in ProteinsList.proteins:
-                        proteins_numbers[(str(i))]=l
-                        l += 1
-                        clusterPresenceOut.write('%s' % i +'\t')
-                    clusterPresenceOut.write('\n')
-                    logger.info( 'Extracting conserved waters from clusters ...' )
-                    logger.debug( 'Start iterating over all clusters ...')
-                    for clusterNumber, waterMols in fcDic.items():
-                        logger.debug('Cluster No.: %s - Included Water Molecules: %s' % ( clusterNumber, ', '.join( waterMols ) ))
-                        waterMolsNumber = len(waterMols)
-                        uniquePDBs = set([a[:6] for a in waterMols])
-                        uniquePDBslen = len(uniquePDBs)
-                        # Update waterMols if there are two waterMolecules from same PDB is present in waterMols
-                        if uniquePDBslen < waterMolsNumber:
-                            logger.debug('Removed water molecules from the same protein in one cluster.')
-                            waterMols.sort()
-                            PDBs = [i[:6] for i in waterMols]
-                            PDBsCounter = collections.Counter(PDBs)
-                            for i in PDBsCounter.keys():
-                                if PDBsCounter.get(i) > 1:
-                                    for j in reversed(waterMols):
-                                        if j[:6] == i:
-                                            waterMols.remove(j)
-                        c = []
-                        for i in range(len(ProteinsList.proteins)):
-                            for prot in proteins_numbers.keys():
-                                if proteins_numbers[prot] == i:
-                                    for d in waterMols:
-                                        if prot == d[:6]:
-                                            c.append(d)
-                        waterMols = c
-                        waterMolsNumber = len(waterMols)
-                        uniquePDBs = set([a[:6] for a in waterMols])
-                        uniquePDBslen = len(uniquePDBs)
-                        probability = float(uniquePDBslen) / len(ProteinsList)
-                        logger.info( 'Degree of conservation is: %s' % probability )
-                        if probability >= ProteinsList.probability:
-                            clusterPresenceOut.write(str(probability)+'\t')
-                            k=0
-                            for waterMol in waterMols:
-                                sr_no = proteins_numbers[waterMol[:6]]
-                                if sr_no == k:
-                                    clusterPresenceOut.write(str(waterMol[7:])+'\t')
-                                    k += 1
-                                elif k < sr_no:
-                                    for j in range(sr_no-k):
-                                        clusterPresenceOut.write('NoWater'+'\t')
-                                        k += 1
-                                    clusterPresenceOut.write(str(waterMol[7:])+'\t')
-                                    k += 1
-                            for j in range(len(ProteinsList.proteins)-k):
-                                clusterPresenceOut.write('NoWater'+'\t')
-                            clusterPresenceOut.write('\n')
-
-                            if selectedPDBChain in uniquePDBs:
-                                cwm_count += 1
-                                for waterMol in waterMols:
-                                    if waterMol[:6] in conservedWaterDic:
-                                        conservedWaterDic[waterMol[:6]].append('_'.join([waterMol[7:], str(probability)]))
-                                    else:
-                                        conservedWaterDic[waterMol[:6]] = ['_'.join([waterMol[7:], str(probability)])]
-                    clusterPresenceOut.close()
-                    logger.debug( 'conservedWaterDic is: ')
-                    for pdb_id, atoms in conservedWaterDic.items():
-                        logger.debug('Oxygen atom numbers for %s: %s' % ( pdb_id, ', '.join( atoms ) ))
-                    if selectedPDBChain in conservedWaterDic.keys():
-                        # save pdb file of only conserved waters for selected pdb
-                        atomNumbersProbDic = {}
-                        atomNumbers_Prob = conservedWaterDic[selectedPDBChain]
-                        logger.info( """Degree of conservation for each conserved water molecule is stored in cwm_%s_withConservedWaters.pdb with the format 'atomNumber'_'DegreeOfConservation'""" % ( selectedPDBChain ) )
-                        for probability in atomNumbers_Prob:
-                            atom, prob = probability.split('_')
-                            atomNumbersProbDic[ atom ] = float( prob )
-                        atomNumbers = list(atomNumbersProbDic.keys())
-                        selectedPDBChainConservedWatersOut = open(os.path.join(temp_dir, 'cwm_'+selectedPDBChain+'_ConservedWatersOnly.pdb'),'w+')
-                        selectedPDBChainIn = open(os.path.join(temp_dir, 'cwm_'+selectedPDBChain+'_Water.pdb'))
-                        for line in selectedPDBChainIn:
-                            if line.startswith('HETATM'):
-                                if str(int(line[22:30])) in atomNumbers:
-                                    selectedPDBChainConservedWatersOut.write( line )
-                        selectedPDBChainConservedWatersOut.write('END')
-                        selectedPDBChainConservedWatersOut.close()
-
-                        # add conserved waters to pdb file
-                        cmd.delete('cwm_*')
-                        cmd.load( os.path.join(temp_dir, 'cwm_%s.pdb' % selectedPDBChain) )
-                        cmd.load( os.path.join(temp_dir, 'cwm_%s_ConservedWatersOnly.pdb' % selectedPDBChain) )
-                        cmd.remove( 'resname hoh and '+'cwm_%s' % selectedPDBChain )
-                        cmd.save( os.path.join(temp_dir, 'cwm_%s_withConservedWaters.pdb' % selectedPDBChain), 'cwm_*')
-                        cmd.delete('cwm_*')
-                        shutil.copy( os.path.join(temp_dir, 'cwm_%s_withConservedWaters.pdb' % selectedPDBChain), os.path.join(outdir,selectedPDBChain))
-                        shutil.copy(os.path.join(temp_dir, 'cwm_%s.pdb' % selectedPDBChain),os.path.join(outdir,selectedPDBChain))
-                        if os.path.exists(os.path.join(outdir, selectedPDBChain, 'cwm_%s_withConservedWaters.pdb' % selectedPDBChain)):
-                            logger.info( "%s structure has %s conserved water molecules." % (selectedPDBChain,cwm_count))
-                            displayInPyMOL(os.path.join(outdir, selectedPDBChain), 'cwm_%s' % selectedPDBChain, atomNumbersProbDic)
-                        logger.info("""PDB file of query protein with conserved waters "cwm_%s_withConservedWaters.pdb" and logfile (pywater.log) is saved in %s""" % ( selectedPDBChain, os.path.abspath(outdir)))
-                    else:
-                        logger.info( "%s has no conserved waters" % selectedPDBChain )
-                else:
-                    logger.error( "%s has too many waters to cluster. Memory is not enough..." % selectedPDBChain )
-            else:
-                logger.info( "%s has only one water molecule..." % selectedPDBChain )
-        else:
-            logger.info( "%s and other structures from the same cluster do not have any water molecules." % selectedPDBChain )
+            return {'status': 'no waters', 'approximate': approximate}
+        logger.info( 'Number of water molecules to cluster: %i' % len(water_coordinates) )
+        if len(water_coordinates) == 1:
+            return {'status': 'one water', 'approximate': approximate}
+        # Only if the total number of water molecules to cluster is less than 50000.
+        # The density method runs in near-linear time and has no such limit.
+        if len(water_coordinates) >= 50000 and ProteinsList.clustering_method != 'density':
+            return {'status': 'too many waters', 'approximate': approximate}
+        logger.info( 'Clustering the water coordinates ...' )
+        # The clustering returns a list of clusternumbers
+        FD = clusterWaters(water_coordinates, water_ids,
+                ProteinsList.clustering_method,
+                ProteinsList.inconsistency_coefficient
+            )
+        np.savez(os.path.join(stage_dir, 'clusters.npz'), water_ids = np.array(water_ids), cluster_numbers = FD,
+            water_coordinates = np.asarray(water_coordinates, dtype=float))
+        return {'status': 'ok', 'approximate': approximate}
+    key, result, clustering_dir = cache.run('clustering', {
+            'clustering_method': ProteinsList.clustering_method,
+            'inconsistency_coefficient': ProteinsList.inconsistency_coefficient,
+            'query_anchored': ProteinsList.query_anchored,
+        }, key, clustering)
+    approximate = result['approximate']
+    if result['status'] == 'no waters':
+        logger.info( "%s and other structures from the same cluster do not have any water molecules." % selectedPDBChain )
+        return None
+    if result['status'] == 'one water':
+        logger.info( "%s has only one water molecule..." % selectedPDBChain )
+        return None
+    if result['status'] == 'too many waters':
+        logger.error( "%s has too many waters to cluster. Memory is not enough..." % selectedPDBChain )
+        return None
+
+    def extraction(stage_dir):
+        logger.info( 'Extracting conserved waters from clusters ...' )
+        clusters = np.load(os.path.join(clustering_dir, 'clusters.npz'))
+        clusterPresenceOut = open(os.path.join( stage_dir, '%s_clusterPresence.txt' % selectedPDBChain ),'w')
+        presence = ClusterPresence([str(water_id) for water_id in clusters['water_ids']], clusters['cluster_numbers'], ProteinsList.proteins)
+        conserved = np.flatnonzero(presence.degree >= ProteinsList.probability)
+        # conserved waters of the query, unless selected by their stability
+        selected = conserved
+        if ProteinsList.confidence and selectedPDBChain in presence.proteins:
+            # resample the member chains for the clusters with a water of the query
+            query = presence.proteins.index(selectedPDBChain)
+            candidates = np.unique(presence.cluster_index[presence.protein_index == query])
+            intervals = conservationIntervals(presence.matrix(candidates) >= 0, ProteinsList.confidence,
+                ProteinsList.probability, ProteinsList.resamples)
+            if ProteinsList.stability:
+                logger.info( 'Selecting conserved waters with a degree of conservation >= %s in at least %s of the bootstrap resamples' % (ProteinsList.probability, ProteinsList.stability))
+                selected = candidates[intervals['stability'] >= ProteinsList.stability]
+                # the presence table keeps all clusters above the cutoff
+                conserved = np.union1d(conserved, selected)
+            confidenceOut = open(os.path.join( stage_dir, '%s_confidence.txt' % selectedPDBChain ),'w')
+            writeConservationIntervals(confidenceOut, presence, candidates, query, intervals, selected)
+            confidenceOut.close()
+        table = presence.matrix(conserved)
+        writeClusterPresence(clusterPresenceOut, presence, conserved, table)
+        clusterPresenceOut.close()
+        writeFamilySites(os.path.join(stage_dir, '%s_sites.npz' % selectedPDBChain), presence, clusters['water_coordinates'],
+            os.path.join(superposition_dir, 'cwm_%s.pdb' % selectedPDBChain), ProteinsList)
+
+        atomNumbersProbDic = {}
+        if selectedPDBChain in presence.proteins:
+            query = presence.proteins.index(selectedPDBChain)
+            selected = set(selected)
+            for cluster, row in zip(conserved, table):
+                if row[query] >= 0 and cluster in selected:
+                    atomNumbersProbDic[ presence.water_number(row[query]) ] = float( presence.degree[cluster] )
+        return atomNumbersProbDic
+    key, atomNumbersProbDic, extraction_dir = cache.run('extraction', {
+            'probability': ProteinsList.probability,
+            'confidence': ProteinsList.confidence,
+            'resamples': ProteinsList.resamples,
+            'stability': ProteinsList.stability,
+        }, key, extraction)
+    if ProteinsList.query_anchored:
+        logger.info( 'Query-anchored pruning: %s_clusterPresence.txt only lists clusters reachable from %s, %s' % (selectedPDBChain, selectedPDBChain, 'approximate' if approximate else 'exact'))
+    for name in ('clusterPresence.txt', 'confidence.txt', 'sites.npz'):
+        if os.path.exists(os.path.join(extraction_dir, '%s_%s' % (selectedPDBChain, name))):
+            shutil.copy(os.path.join(extraction_dir, '%s_%s' % (selectedPDBChain, name)), os.path.join(outdir, selectedPDBChain))
+
+    cwm_count = len(atomNumbersProbDic)
+    logger.debug( 'Oxygen atom numbers and degree of conservation for %s: %s' % ( selectedPDBChain, ', '.join( '%s_%s' % item for item in atomNumbersProbDic.items() ) ))
+    if atomNumbersProbDic:
+        # save pdb file of only conserved waters for selected pdb
+        logger.info( """Degree of conservation for each conserved water molecule is stored in cwm_%s_withConservedWaters.pdb with the format 'atomNumber'_'DegreeOfConservation'""" % ( selectedPDBChain ) )
+        atomNumbers = list(atomNumbersProbDic.keys())
+        selectedPDBChainConservedWatersOut = open(os.path.join(temp_dir, 'cwm_'+selectedPDBChain+'_ConservedWatersOnly.pdb'),'w+')
+        selectedPDBChainIn = open(os.path.join(superposition_dir, 'cwm_'+selectedPDBChain+'_Water.pdb'))
+        for line in selectedPDBChainIn:
+            if line.startswith('HETATM'):
+                if str(int(line[22:30])) in atomNumbers:
+                    selectedPDBChainConservedWatersOut.write( line )
+        selectedPDBChainConservedWatersOut.write('END')
+        selectedPDBChainConservedWatersOut.close()
+
+        # add conserved waters to pdb file
+        with PYMOL_LOCK:
+            cmd.delete('cwm_*')
+            cmd.load( os.path.join(superposition_dir, 'cwm_%s.pdb' % selectedPDBChain) )
+            cmd.load( os.path.join(temp_dir, 'cwm_%s_ConservedWatersOnly.pdb' % selectedPDBChain) )
+            cmd.remove( 'resname hoh and '+'cwm_%s' % selectedPDBChain )
+            cmd.save( os.path.join(temp_dir, 'cwm_%s_withConservedWaters.pdb' % selectedPDBChain), 'cwm_*')
+            cmd.delete('cwm_*')
+        if approximate:
+            addRemark( os.path.join(temp_dir, 'cwm_%s_withConservedWaters.pdb' % selectedPDBChain),
+                'APPROXIMATE: degrees of conservation from query-anchored pruning with %s clustering' % ProteinsList.clustering_method)
+        shutil.copy( os.path.join(temp_dir, 'cwm_%s_withConservedWaters.pdb' % selectedPDBChain), os.path.join(outdir,selectedPDBChain))
+        shutil.copy(os.path.join(superposition_dir, 'cwm_%s.pdb' % selectedPDBChain),os.path.join(outdir,selectedPDBChain))
+        if os.path.exists(os.path.join(outdir, selectedPDBChain, 'cwm_%s_withConservedWaters.pdb' % selectedPDBChain)):
+            logger.info( "%s structure has %s conserved water molecules." % (selectedPDBChain,cwm_count))
+            if display:
+                displayInPyMOL(os.path.join(outdir, selectedPDBChain), 'cwm_%s' % selectedPDBChain, atomNumbersProbDic,
+                    density_map, ProteinsList.probability / 2.0)
+        logger.info("""PDB file of query protein with conserved waters "cwm_%s_withConservedWaters.pdb" and logfile (pywater.log) is saved in %s""" % ( selectedPDBChain, os.path.abspath(outdir)))
     else:
-        logger.error( "%s has only one PDB structure. We need atleast 2 structures to superimpose." % selectedPDBChain )
+        logger.info( "%s has no conserved waters" % selectedPDBChain )
+    return atomNumbersProbDic
 
 
-def pdbIdFormat( pdbId ):
+def wilsonInterval( degree, n, z = 1.96 ):
+    """
+        Wilson score interval of a degree of conservation observed in n chains.
+        Returns the lower and upper bounds.
+    """
+    degree = np.asarray(degree, dtype=float)
+    centre = (degree + z * z / (2.0 * n)) / (1 + z * z / float(n))
+    spread = z * np.sqrt(degree * (1 - degree) / n + z * z / (4.0 * n * n)) / (1 + z * z / float(n))
+    return np.clip(centre - spread, 0, 1), np.clip(centre + spread, 0, 1)
+
+
+def progressiveConservedWaters( ProteinsList, temp_dir, outdir, save_sup_files, display = True, cache = None, upstream = '', batch_size = 10, resolutions = None ):
+    """
+        Progressive preview: run on the query and the batch_size best resolved chains first and show the
+        provisional conserved waters, then rerun with twice as many chains until all chains are used.
+        Doubling keeps the total work within about twice that of a single run, structures are downloaded
+        only once. The output files and the display are replaced in every round; the degrees of
+        conservation with their 95 % Wilson intervals of every round are written to xxxx_x_progress.txt.
+        Returns the conserved waters of the final round.
+    """
+    cache = cache or StageCache(temp_dir)
+    resolutions = resolutions or {}
+    selectedPDBChain = str(ProteinsList.selectedPDBChain)
+
+    def resolution(protein):
+        value = resolutions.get(protein.pdb_id.upper(), 'null')
+        return float(value) if value != 'null' else float('inf')
+    chains = ProteinsList.proteins[:1] + sorted(ProteinsList.proteins[1:], key=resolution)
+
+    if not os.path.exists(os.path.join(outdir, selectedPDBChain)):
+        os.mkdir(os.path.join(outdir, selectedPDBChain))
+    progressOut = open(os.path.join(outdir, selectedPDBChain, '%s_progress.txt' % selectedPDBChain), 'w')
+    progressOut.write('chains\tof\twater number\tdegree of conservation\tlower 95% bound\tupper 95% bound\n')
+    # the query (first chain) and n_members other chains
+    n_members = max(int(batch_size), 1)
+    while True:
+        n_chains = min(n_members + 1, len(chains))
+        final = n_chains == len(chains)
+        logger.info( 'Progressive preview: %i of %i chains ...' % (n_chains, len(chains)))
+        subset = copy.copy(ProteinsList)
+        subset.proteins = [Protein(protein.pdb_id, protein.chain) for protein in chains[:n_chains]]
+        atomNumbersProbDic = makePDBwithConservedWaters(subset, temp_dir, outdir, save_sup_files and final, display, cache, upstream)
+        if atomNumbersProbDic:
+            # the degrees of conservation are relative to the chains left after the refinement filter
+            n = len(subset.proteins)
+            waters = sorted(atomNumbersProbDic, key=int)
+            lower, upper = wilsonInterval([atomNumbersProbDic[water] for water in waters], n)
+            for water, low, high in zip(waters, lower, upper):
+                progressOut.write('%i\t%i\t%s\t%.3f\t%.3f\t%.3f\n' % (n, len(chains), water, atomNumbersProbDic[water], low, high))
+                if display:
+                    cmd.label('conserved_waters and resi %s and name %s' % (water, '+'.join(WATER_OXYGENS)), '"%.2f [%.2f-%.2f]"' % (atomNumbersProbDic[water], low, high))
+            progressOut.flush()
+            if not final:
+                addRemark(os.path.join(outdir, selectedPDBChain, 'cwm_%s_withConservedWaters.pdb' % selectedPDBChain),
+                    'PROVISIONAL: degrees of conservation from %i of %i chains' % (n_chains, len(chains)))
+            if display:
+                cmd.refresh()
+        if final:
+            break
+        n_members *= 2
+    progressOut.close()
+    ProteinsList.proteins = subset.proteins
+    ProteinsList.anchor_waters = subset.anchor_waters
+    return atomNumbersProbDic
+
+
+def errorMessage( message, display = True ):
+    """
+        Show an error message box, unless PyWATER runs without display (batch nodes and service workers).
+    """
+    if display:
+        tkMessageBox.showinfo(title = 'Error message', message = message)
+
+
+def pdbIdFormat( pdbId, display = True ):
     """
         Check whether the given PDB ID is valid or not.
     """
     if not re.compile('^[a-z0-9]{4}$').match(pdbId):
         logger.error( 'The entered PDB id %s is not valid.' % pdbId)
-        tkMessageBox.showinfo(title = 'Error message', 
-            message = """The entered PDB id is not valid.""")
+        errorMessage("""The entered PDB id is not valid.""", display)
         return False
     else:
         return True
 
 
-def chainIdFormat(chainId):
+def chainIdFormat(chainId, display = True):
     """
         Check whether the given PDB Chain ID is valid or not.
     """
     if not re.compile('^[A-Z0-9]{1}$').match(chainId):
         logger.error( 'The entered PDB chain id %s is not valid.' % chainId)
-        tkMessageBox.showinfo(title = 'Error message', 
-            message = """The entered PDB chain id is not valid.""")
+        errorMessage("""The entered PDB chain id is not valid.""", display)
         return False
     else:
         return True
 
 
-def isXray( pdb ):
+SEQUENCE_IDENTITIES = ['30', '40', '50', '70', '90', '95', '100']
+REFINEMENT_METHODS = ('Mobility', 'Normalized B-factor', 'No refinement')
+
+
+def readJSONGzip( path ):
+    handle = gzip.open(path, 'rb')
+    data = json.loads(handle.read().decode('utf-8'))
+    handle.close()
+    return data
+
+
+def writeJSONGzip( path, data ):
+    """
+        Write a gzipped JSON file by renaming a complete temporary file.
+    """
+    tmp_path = '%s.%s-%s.tmp' % (path, socket.gethostname(), os.getpid())
+    handle = gzip.open(tmp_path, 'wb')
+    handle.write(json.dumps(data, separators=(',', ':')).encode('utf-8'))
+    handle.close()
+    os.rename(tmp_path, path)
+
+
+def buildPDBIndex( bulk_dir, index_dir ):
+    """
+        Index the bulk files of the PDB in bulk_dir for runs without network access:
+        the BlastClust sequence clusters bc-30.out ... bc-100.out (one cluster of XXXX_X chains per line)
+        and the entry listings entries.idx (experimental method and resolution) and resolu.idx (resolution).
+        Plain or gzipped files are read. Returns the number of indexed entries.
+    """
+    if not os.path.exists(index_dir):
+        os.makedirs(index_dir)
+    for seq_id in SEQUENCE_IDENTITIES:
+        paths = [path for path in (os.path.join(bulk_dir, 'bc-%s.out' % seq_id), os.path.join(bulk_dir, 'bc-%s.out.gz' % seq_id)) if os.path.exists(path)]
+        if not paths:
+            continue
+        clusters = [line.upper().split() for line in readPDBLines(paths[0]) if line.strip()]
+        writeJSONGzip(os.path.join(index_dir, 'clusters-%s.json.gz' % seq_id), clusters)
+        logger.info( 'Indexed %i sequence clusters at %s %% identity.' % (len(clusters), seq_id))
+
+    entries = {}
+    for name in ('entries.idx', 'entries.idx.gz'):
+        if os.path.exists(os.path.join(bulk_dir, name)):
+            for line in readPDBLines(os.path.join(bulk_dir, name)):
+                fields = line.rstrip('\r\n').split('\t')
+                if len(fields) < 8 or not re.match('^[0-9][A-Za-z0-9]{3}$', fields[0]):
+                    continue
+                entries[fields[0].lower()] = [fields[7].strip().upper(), resolutionValue(fields[6])]
+            break
+    for name in ('resolu.idx', 'resolu.idx.gz'):
+        if os.path.exists(os.path.join(bulk_dir, name)):
+            for line in readPDBLines(os.path.join(bulk_dir, name)):
+                fields = [field.strip() for field in line.split(';')]
+                if len(fields) != 2 or not re.match('^[0-9][A-Za-z0-9]{3}$', fields[0]):
+                    continue
+                entries.setdefault(fields[0].lower(), ['', 'null'])[1] = resolutionValue(fields[1])
+            break
+    writeJSONGzip(os.path.join(index_dir, 'entries.json.gz'), entries)
+    PDB_INDEXES.pop(os.path.abspath(index_dir), None)
+    logger.info( 'Local PDB index in %s contains %i entries.' % (index_dir, len(entries)))
+    return len(entries)
+
+
+def resolutionValue( field ):
+    """
+        Resolution of a bulk file field as in the REST reports: a number, or 'null' if there is none.
+    """
+    try:
+        resolution = float(field.split(',')[0])
+    except ValueError:
+        return 'null'
+    if resolution <= 0:
+        return 'null'
+    return str(resolution)
+
+
+class LocalPDBIndex():
+    """
+        Sequence clusters, experimental methods and resolutions from an index built by buildPDBIndex.
+        Every file is loaded on first use into dictionaries, so later lookups are O(1).
+    """
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        self._clusters = {}
+        self._entries = None
+
+    def clusters(self, seq_id):
+        """
+            Chain (XXXX_X) to cluster members dictionary at the sequence identity seq_id.
+        """
+        if seq_id not in self._clusters:
+            path = os.path.join(self.index_dir, 'clusters-%s.json.gz' % seq_id)
+            self._clusters[seq_id] = {}
+            if os.path.exists(path):
+                for members in readJSONGzip(path):
+                    for member in members:
+                        self._clusters[seq_id][member] = members
+            else:
+                logger.error( 'The local PDB index has no sequence clusters at %s %% identity.' % seq_id)
+        return self._clusters[seq_id]
+
+    def entries(self):
+        if self._entries is None:
+            self._entries = readJSONGzip(os.path.join(self.index_dir, 'entries.json.gz'))
+        return self._entries
+
+    def cluster(self, seq_id, pdb, chain):
+        return self.clusters(seq_id).get('%s_%s' % (pdb.upper(), chain.upper()), [])
+
+    def has_chain(self, pdb, chain):
+        for seq_id in ['100'] + SEQUENCE_IDENTITIES:
+            if os.path.exists(os.path.join(self.index_dir, 'clusters-%s.json.gz' % seq_id)):
+                return '%s_%s' % (pdb.upper(), chain.upper()) in self.clusters(seq_id)
+        return False
+
+    def method(self, pdb):
+        return self.entries().get(pdb.lower(), ['', 'null'])[0]
+
+    def resolution(self, pdb):
+        return self.entries().get(pdb.lower(), ['', 'null'])[1]
+
+
+PDB_INDEXES = {}
+
+
+def openPDBIndex( index_dir ):
+    """
+        The LocalPDBIndex of index_dir, shared by all runs of this session so its files are loaded only once.
+    """
+    index_dir = os.path.abspath(index_dir)
+    if index_dir not in PDB_INDEXES:
+        PDB_INDEXES[index_dir] = LocalPDBIndex(index_dir)
+    return PDB_INDEXES[index_dir]
+
+
+def isXray( pdb, index = None ):
     """
         Check whether the PDB structure is determined by X-ray or not.
     """
+    if index is not None:
+        return index.method(pdb) == 'X-RAY DIFFRACTION'
     expInfoAddress='http://pdb.org/pdb/rest/customReport?pdbids=%s&customReportColumns=experimentalTechnique&service=wsdisplay&format=xml&ssa=n' % (pdb)
     #the PDB service API have changed
     expInfoAddress='http://www.rcsb.org/pdb/rest/customReport?pdbids=%s&customReportColumns=experimentalTechnique&service=wsdisplay&format=xml&ssa=n' % (pdb)
@@ -671,10 +2186,12 @@ def isXray( pdb ):
     else:
         return False
 
-def chainPresent(pdb,chain):
+def chainPresent(pdb,chain,index=None):
     """
         Check whether the given chain id is valid for a given PDB ID.
     """
+    if index is not None:
+        return index.has_chain(pdb, chain)
     chainInfoAddress='http://pdb.org/pdb/rest/customReport?pdbids=%s&customReportColumns=entityId&service=wsdisplay&format=xml&ssa=n' % pdb
     chainInfoURL = urllib.urlopen(chainInfoAddress)
     url_string = chainInfoURL.read()
@@ -685,11 +2202,17 @@ def chainPresent(pdb,chain):
     else:
         return False
 
-def fetchpdbChainsList( selectedStruture, seq_id ):
+def fetchpdbChainsList( selectedStruture, seq_id, index = None ):
     """
-        Fetch sequence cluster data from RCSB PDB for a given query protein.
+        Fetch sequence cluster data from RCSB PDB (or the local PDB index) for a given query protein.
     """
     pdbChainsList = []
+    if index is not None:
+        pdb, chain = selectedStruture.split('.')
+        for pdbChain in index.cluster(seq_id, pdb, chain):
+            if isXray(pdbChain[:4], index):
+                pdbChainsList.append(pdbChain.replace('_', ':'))
+        return pdbChainsList
     # http://pdb.org/pdb/rest/sequenceCluster?cluster=95&structureId=3qkl.A
     seqClustAddress = 'http://pdb.org/pdb/rest/sequenceCluster?cluster=%s&structureId=%s' % (seq_id, selectedStruture)
     seqClustURL = urllib.urlopen(seqClustAddress)
@@ -706,9 +2229,10 @@ def fetchpdbChainsList( selectedStruture, seq_id ):
         return pdbChainsList
 
 
-def filterbyResolution( pdbChainsList, resolutionCutoff ):
+def filterbyResolution( pdbChainsList, resolutionCutoff, index = None, resolutions = None ):
     """
         Filter the list of PDB structures by given resolution cutoff.
+        The resolution of every structure is added to the dictionary resolutions, if given.
     """
     pdbsList = []
     for pdbChain in pdbChainsList:
@@ -718,10 +2242,13 @@ def filterbyResolution( pdbChainsList, resolutionCutoff ):
     filteredpdbChainsList = []
     pdbsResolution = {}
     for pdb in pdbsList:
-        getResolutionAddress ='http://pdb.org/pdb/rest/customReport?pdbids=%s&customReportColumns=resolution&service=wsfile&format=xml&ssa=n' % (pdb)
-        pdbsResolution_string = urllib.urlopen( getResolutionAddress ).read()
-        pdbsResolutionXML = parseString( pdbsResolution_string )
-        res = str(pdbsResolutionXML.getElementsByTagName('dimStructure.resolution')[0].childNodes[0].nodeValue)
+        if index is not None:
+            res = index.resolution(pdb)
+        else:
+            getResolutionAddress ='http://pdb.org/pdb/rest/customReport?pdbids=%s&customReportColumns=resolution&service=wsfile&format=xml&ssa=n' % (pdb)
+            pdbsResolution_string = urllib.urlopen( getResolutionAddress ).read()
+            pdbsResolutionXML = parseString( pdbsResolution_string )
+            res = str(pdbsResolutionXML.getElementsByTagName('dimStructure.resolution')[0].childNodes[0].nodeValue)
         pdbsResolution[ pdb ] = res
         logger.info('Resolution of %s is: %s' % (pdb, res))
 
@@ -731,41 +2258,51 @@ def filterbyResolution( pdbChainsList, resolutionCutoff ):
             if float(resolution) <= resolutionCutoff:
                 filteredpdbChainsList.append(pdbChain)
 
+    if resolutions is not None:
+        resolutions.update(pdbsResolution)
     return filteredpdbChainsList
 
 
-def FindConservedWaters(selectedStruturePDB,selectedStrutureChain,seq_id,resolution,refinement,user_def_list,clustering_method,inconsistency_coefficient,prob,save_sup_files=True):# e.g: selectedStruturePDB='3qkl',selectedStrutureChain='A'
+def FindConservedWaters(selectedStruturePDB,selectedStrutureChain,seq_id,resolution,refinement,user_def_list,clustering_method,inconsistency_coefficient,prob,save_sup_files=True,atlas_dir='',query_anchored=False,anchor_selection='',output_dir=None,display=True,work_dir='',index_dir='',progressive=0,confidence='',resamples=1000,stability=0.0,n_procs=1,cache=None,map_spacing=0.0,map_extent=5.0):# e.g: selectedStruturePDB='3qkl',selectedStrutureChain='A'
     """
         The main function: Identification of conserved water molecules from a given protein structure.
+        Returns a dictionary of the conserved water numbers of the query and their degree of conservation,
+        or None if no prediction could be made.
+        With work_dir the output of every stage is kept there and reused by later runs with the same inputs.
+        With index_dir sequence clusters, methods and resolutions are looked up in the local PDB index.
+        With progressive > 1 provisional results of the best resolved chains are shown first, see progressiveConservedWaters.
+        A StageCache given as cache is used instead of work_dir, e.g. the cache of the service shared in memory.
     """
-    try:
-        response=urllib.urlopen('http://www.rcsb.org')
-    except:
-        logger.error('The PDB webserver is not reachable.')
-        return None
-    if not pdbIdFormat(selectedStruturePDB):
+    output_dir = output_dir or outdir
+    index = None
+    if index_dir:
+        logger.info( 'Using local PDB index: %s' % index_dir )
+        index = openPDBIndex(index_dir)
+    else:
+        try:
+            response=urllib.urlopen('http://www.rcsb.org')
+        except:
+            logger.error('The PDB webserver is not reachable.')
+            return None
+    if not pdbIdFormat(selectedStruturePDB, display):
         return None
-    if not isXray(selectedStruturePDB):
+    if not isXray(selectedStruturePDB, index):
         logger.error( 'The entered PDB structure is not determined by X-ray crystallography.' )
-        tkMessageBox.showinfo(title = 'Error message', 
-            message = """The entered PDB structure is not determined by X-ray crystallography.""")
+        errorMessage("""The entered PDB structure is not determined by X-ray crystallography.""", display)
         return None
-    if not chainIdFormat(selectedStrutureChain):
+    if not chainIdFormat(selectedStrutureChain, display):
         return None
-    if not chainPresent(selectedStruturePDB,selectedStrutureChain):
+    if not chainPresent(selectedStruturePDB,selectedStrutureChain,index):
         logger.error( 'The entered PDB chain id is not valid for given PDB.' )
-        tkMessageBox.showinfo(title = 'Error message', 
-            message = """The entered PDB chain id is not valid for given PDB.""")
+        errorMessage("""The entered PDB chain id is not valid for given PDB.""", display)
         return None
-    if seq_id not in ['30', '40', '50', '70', '90', '95', '100']:
+    if seq_id not in SEQUENCE_IDENTITIES:
         logger.error( 'The entered sequence identity value is not valid. Please enter a value from list 30, 40, 50, 70, 90, 95 or 100' )
-        tkMessageBox.showinfo(title = 'Error message', 
-            message = """The entered sequence identity value is not valid. Please enter a value from list 30, 40, 50, 70, 90, 95 or 100.""")
+        errorMessage("""The entered sequence identity value is not valid. Please enter a value from list 30, 40, 50, 70, 90, 95 or 100.""", display)
         return None
     if resolution > 3.0:
         logger.info( 'The maximum allowed resolution cutoff is 3.0 A' )
-        tkMessageBox.showinfo(title = 'Error message', 
-            message = """The maximum allowed resolution cutoff is 3.0 A.""")
+        errorMessage("""The maximum allowed resolution cutoff is 3.0 A.""", display)
         return None
     UD_pdbChainsList = []
     if user_def_list != '':
@@ -774,79 +2311,962 @@ def FindConservedWaters(selectedStruturePDB,selectedStrutureChain,seq_id,resolut
                 if len(i.split('_')) == 2:
                     pdbid,chainid = i.split('_')[0].lower(),i.split('_')[1].upper()
                     j = ':'.join([pdbid,chainid])
-                    if not pdbIdFormat(pdbid):
+                    if not pdbIdFormat(pdbid, display):
                         return None
-                    if not chainIdFormat(chainid):
+                    if not chainIdFormat(chainid, display):
                         return None
                     else:
                         UD_pdbChainsList.append(j)
                 else:
                     logger.info( 'Please enter atleast two pdb chains identifier in the format: xxxx_x,yyyy_y,zzzz_z' )
-                    tkMessageBox.showinfo(title = 'Error message',
-                        message = """Please enter atleast two pdb chains identifier in the format: xxxx_x,yyyy_y,zzzz_z""")
+                    errorMessage("""Please enter atleast two pdb chains identifier in the format: xxxx_x,yyyy_y,zzzz_z""", display)
                     return None
         else:
             logger.info( 'Please enter atleast two pdb chains identifier in the format: xxxx_x,yyyy_y,zzzz_z' )
-            tkMessageBox.showinfo(title = 'Error message', 
-                message = """Please enter atleast two pdb chains identifier in the format: xxxx_x,yyyy_y,zzzz_z""")
+            errorMessage("""Please enter atleast two pdb chains identifier in the format: xxxx_x,yyyy_y,zzzz_z""", display)
             return None
+    if clustering_method not in CLUSTERING_METHODS:
+        logger.error( 'The entered clustering method is not valid. Please choose one from %s' % ', '.join(CLUSTERING_METHODS) )
+        errorMessage("""The entered clustering method is not valid. Please choose one from %s.""" % ', '.join(CLUSTERING_METHODS), display)
+        return None
+    if confidence and confidence not in CONFIDENCE_METHODS:
+        logger.error( 'The entered confidence method is not valid. Please choose one from %s' % ', '.join(CONFIDENCE_METHODS) )
+        errorMessage("""The entered confidence method is not valid. Please choose one from %s.""" % ', '.join(CONFIDENCE_METHODS), display)
+        return None
+    if stability and confidence == 'jackknife':
+        logger.error( 'The stability selection needs bootstrap resampling.' )
+        errorMessage("""The stability selection needs bootstrap resampling.""", display)
+        return None
     if inconsistency_coefficient > 2.8:
         logger.info( 'The maximum allowed inconsistency coefficient threshold is 2.8 A' )
-        tkMessageBox.showinfo(title = 'Error message', 
-            message = """The maximum allowed inconsistency coefficient threshold is 2.8 A.""")
+        errorMessage("""The maximum allowed inconsistency coefficient threshold is 2.8 A.""", display)
         return None
     if prob > 1.0 or prob < 0.4:
         logger.info( 'The degree of conservation is allowed from 0.4 A to 1.0 A.' )
-        tkMessageBox.showinfo(title = 'Error message', 
-            message = """The degree of conservation is allowed from 0.4 A to 1.0 A.""")
+        errorMessage("""The degree of conservation is allowed from 0.4 A to 1.0 A.""", display)
         return None
-    online_pdb_db = 'http://www.pdb.org/pdb/files/%s.pdb'
     displayInputs(selectedStruturePDB,selectedStrutureChain,seq_id,resolution,refinement,user_def_list,clustering_method,inconsistency_coefficient,prob)
 
-    tmp_dir = tempfile.mkdtemp()
-
     selectedStruture = ".".join([selectedStruturePDB.lower(),selectedStrutureChain.upper()]) # 3qkl.A
     up = ProteinsList(ProteinName = selectedStruture) # ProteinsList class instance up
     up.refinement = refinement
     up.probability = prob
     up.clustering_method = clustering_method
     up.inconsistency_coefficient = inconsistency_coefficient
+    if atlas_dir:
+        logger.info( 'Using water atlas: %s' % atlas_dir )
+        up.atlas = WaterAtlas(atlas_dir)
+    up.query_anchored = bool(query_anchored or anchor_selection)
+    up.anchor_selection = anchor_selection
+    up.confidence = 'bootstrap' if stability and not confidence else confidence
+    up.resamples = int(resamples)
+    up.stability = float(stability)
+    up.n_procs = max(int(n_procs), 1)
+    up.map_spacing = float(map_spacing)
+    up.map_extent = float(map_extent)
     logger.info( 'selectedStruture is : %s' % selectedStruture )
     up.selectedPDBChain = Protein(selectedStruturePDB, selectedStrutureChain) # up.selectedPDBChain = 3qkl_a
     logger.info( 'up selectedPDBChain is : %s' % up.selectedPDBChain )
     selectedPDBChain = str(up.selectedPDBChain)
     logger.info( 'selectedPDBChain name is : %s' % selectedPDBChain )
-    if UD_pdbChainsList == []:
-        logger.info( """Fetching protein chains list from PDB clusters ...
-        This cluster contains: """ )
-        pdbChainsList = fetchpdbChainsList(selectedStruture,seq_id) # ['3QKL:A', '4EKL:A', '3QKM:A', '3QKK:A', '3OW4:A', '3OW4:B', '3OCB:A', '3OCB:B', '4EKK:A', '4EKK:B']
-        logger.info( 'Protein chains list contains %i pdb chains: "%s"' % (len(pdbChainsList), ', '.join(pdbChainsList)))
-        logger.info( 'Filtering by resolution ...')
-        pdbChainsList = filterbyResolution(pdbChainsList,resolution)
-        # make sure query structure is not filtered out
-        queryStr = ':'.join(selectedStruture.upper().split('.'))
-        if queryStr in pdbChainsList:
-            pdbChainsList.remove(queryStr)
-            pdbChainsList.insert(0,queryStr)
-        if queryStr not in pdbChainsList:
-            pdbChainsList.insert(0,queryStr)
-        # Added again If query structure filtered out..
-        logger.info( 'Filtered protein chains list contains %i pdb chains: "%s"' % (len(pdbChainsList), ', '.join(pdbChainsList)) )
-    else:
-        pdbChainsList = UD_pdbChainsList
-    for pdbChain in pdbChainsList:
-        up.add_protein_from_string(pdbChain)
-
-    if len(up.proteins)>1:
-        for protein in up:
-            if not os.path.exists(os.path.join(tmp_dir, '%s.pdb' % protein.pdb_id)):
-                logger.info( 'Retrieving structure: %s' % protein.pdb_id)
-                urllib.urlretrieve(online_pdb_db % protein.pdb_id.upper(), os.path.join(tmp_dir, protein.pdb_id+'.pdb'))
-        logger.info( 'Save PDB file with conserved water molecules ...' )
-        makePDBwithConservedWaters(up, tmp_dir, outdir, save_sup_files)
+    tmp_dir = tempfile.mkdtemp()
+    cache = cache or StageCache(work_dir or tmp_dir)
+    try:
+        def members(stage_dir):
+            if UD_pdbChainsList != []:
+                return UD_pdbChainsList
+            logger.info( """Fetching protein chains list from PDB clusters ...
+            This cluster contains: """ )
+            pdbChainsList = fetchpdbChainsList(selectedStruture,seq_id,index) # ['3QKL:A', '4EKL:A', '3QKM:A', '3QKK:A', '3OW4:A', '3OW4:B', '3OCB:A', '3OCB:B', '4EKK:A', '4EKK:B']
+            logger.info( 'Protein chains list contains %i pdb chains: "%s"' % (len(pdbChainsList), ', '.join(pdbChainsList)))
+            return pdbChainsList
+        key, pdbChainsList, stage_dir = cache.run('members', {'query': selectedStruture, 'seq_id': seq_id, 'user_def_list': UD_pdbChainsList, 'index_dir': index_dir}, '', members)
+
+        def metadata(stage_dir):
+            if UD_pdbChainsList != []:
+                return pdbChainsList
+            logger.info( 'Filtering by resolution ...')
+            resolutions = {}
+            filteredpdbChainsList = filterbyResolution(pdbChainsList,resolution,index,resolutions)
+            writeJSONAtomic(os.path.join(stage_dir, 'resolutions.json'), resolutions)
+            # make sure query structure is not filtered out
+            queryStr = ':'.join(selectedStruture.upper().split('.'))
+            if queryStr in filteredpdbChainsList:
+                filteredpdbChainsList.remove(queryStr)
+                filteredpdbChainsList.insert(0,queryStr)
+            if queryStr not in filteredpdbChainsList:
+                filteredpdbChainsList.insert(0,queryStr)
+            # Added again If query structure filtered out..
+            logger.info( 'Filtered protein chains list contains %i pdb chains: "%s"' % (len(filteredpdbChainsList), ', '.join(filteredpdbChainsList)) )
+            return filteredpdbChainsList
+        key, pdbChainsList, stage_dir = cache.run('metadata', {'resolution': resolution}, key, metadata)
+        for pdbChain in pdbChainsList:
+            up.add_protein_from_string(pdbChain)
+
+        atomNumbersProbDic = None
+        if len(up.proteins)>1 and progressive and len(up.proteins) > int(progressive) + 1:
+            resolutions = {}
+            if os.path.exists(os.path.join(stage_dir, 'resolutions.json')):
+                resolutions = json.load(open(os.path.join(stage_dir, 'resolutions.json')))
+            atomNumbersProbDic = progressiveConservedWaters(up, tmp_dir, output_dir, save_sup_files, display, cache, key, int(progressive), resolutions)
+        elif len(up.proteins)>1:
+            logger.info( 'Save PDB file with conserved water molecules ...' )
+            atomNumbersProbDic = makePDBwithConservedWaters(up, tmp_dir, output_dir, save_sup_files, display, cache, key)
+        else:
+            logger.info( "%s has only one PDB structure. We need atleast 2 structures to superimpose." % selectedPDBChain)
+        cache.report()
+    finally:
+        shutil.rmtree(tmp_dir)
+    return atomNumbersProbDic
+
+
+WATER_RESIDUES = ('HOH', 'DOD', 'WAT', 'SOL', 'TIP', 'TIP3', 'TIP4', 'T3P', 'T4P', 'SPC')
+
+WATER_OXYGENS = ('O', 'OW', 'OH2')
+
+WATER_SELECTION = 'resn %s' % '+'.join(WATER_RESIDUES)
+
+
+def iterPDBModels( trajectory ):
+    """
+        Stream the models of a plain or gzipped multi-model PDB file, one list of ATOM/HETATM lines at a time.
+    """
+    handle = gzip.open(trajectory, 'rb') if trajectory.endswith('.gz') else open(trajectory)
+    lines = []
+    for line in handle:
+        if not isinstance(line, str):
+            line = line.decode('ascii', 'replace')
+        if line.startswith('ATOM') or line.startswith('HETATM'):
+            lines.append(line)
+        elif line.startswith('END') and lines:
+            yield lines
+            lines = []
+    if lines:
+        yield lines
+    handle.close()
+
+
+def frameArrays( lines, chain = '' ):
+    """
+        C-alpha coordinates of the chain, water oxygen coordinates and water residue numbers of one model.
+    """
+    ca = []
+    waters = []
+    numbers = []
+    for line in lines:
+        name = line[12:16].strip()
+        if line[17:21].strip() in WATER_RESIDUES and name in WATER_OXYGENS:
+            waters.append([float(line[30:38]), float(line[38:46]), float(line[46:54])])
+            number = line[22:26].strip()
+            numbers.append(int(number) if number.lstrip('-').isdigit() else -len(numbers) - 2)
+        elif name == 'CA' and line.startswith('ATOM') and (not chain or line[21] == chain):
+            ca.append([float(line[30:38]), float(line[38:46]), float(line[46:54])])
+    return np.array(ca, dtype=float).reshape(-1, 3), np.array(waters, dtype=float).reshape(-1, 3), np.array(numbers, dtype=np.int64)
+
+
+def trajectoryFrames( trajectory, topology = '', chain = '', stride = 1 ):
+    """
+        Stream the frames of a multi-model PDB file, or of any trajectory MDAnalysis reads (DCD, XTC, ...)
+        together with its topology, as C-alpha coordinates, water oxygen coordinates and water residue numbers.
+        Every frame also comes with its protein and water oxygen PDB lines, or None for MDAnalysis trajectories.
+    """
+    if not topology:
+        for frame, lines in enumerate(iterPDBModels(trajectory)):
+            if frame % stride == 0:
+                yield frameArrays(lines, chain) + (lines,)
+        return
+    if MDAnalysis is None:
+        raise ImportError('MDAnalysis is needed to read %s, only multi-model PDB files can be read without it.' % trajectory)
+    universe = MDAnalysis.Universe(topology, trajectory)
+    ca = universe.select_atoms('protein and name CA' + (' and (segid %s or chainID %s)' % (chain, chain) if chain else ''))
+    waters = universe.select_atoms('resname %s and name %s' % (' '.join(WATER_RESIDUES), ' '.join(WATER_OXYGENS)))
+    for timestep in universe.trajectory[::stride]:
+        yield ca.positions.astype(float), waters.positions.astype(float), waters.resids.astype(np.int64), None
+
+
+def trajectoryReferenceLines( trajectory, topology, chain, query_frame, work_dir ):
+    """
+        PDB lines of the query frame of an MDAnalysis trajectory, written by MDAnalysis.
+    """
+    universe = MDAnalysis.Universe(topology, trajectory)
+    universe.trajectory[query_frame]
+    path = os.path.join(work_dir, 'query_frame.pdb')
+    universe.select_atoms('protein' + (' and (segid %s or chainID %s)' % (chain, chain) if chain else '')).write(path)
+    lines = [line for line in open(path) if line.startswith('ATOM') or line.startswith('HETATM')]
+    universe.select_atoms('resname %s and name %s' % (' '.join(WATER_RESIDUES), ' '.join(WATER_OXYGENS))).write(path)
+    return lines + [line for line in open(path) if line.startswith('ATOM') or line.startswith('HETATM')]
+
+
+def FindConservedWatersInTrajectory( trajectory, topology = '', chain = '', inconsistency_coefficient = 2.4, prob = 0.7,
+        query_frame = 0, stride = 1, chunk = 100, shell = 5.0, output_dir = None, display = True ):
+    """
+        Conserved hydration sites of a molecular dynamics trajectory, with its frames as the structures.
+        The waters of the query frame within shell of the protein are the sites. All frames are streamed
+        in chunks, superimposed onto the query frame by their C-alpha atoms (same topology, so matched by
+        index) and their waters are assigned to the nearest site within half the inconsistency coefficient
+        threshold by one KD-tree query per chunk. A frame occupies a site if it has a water there.
+        The sites are moved once to the mean position of their waters in the first chunk.
+        Only the site occupancy and a disk backed frame x site presence table are kept, so the memory does
+        not grow with the number of frames.
+        Returns a dictionary of the conserved water numbers of the query frame and their degree of conservation.
+    """
+    output_dir = output_dir or outdir
+    inconsistency_coefficient = float(inconsistency_coefficient)
+    prob = float(prob)
+    query_frame = int(query_frame)
+    stride = max(int(stride), 1)
+    chunk = max(int(chunk), 1)
+    shell = float(shell)
+    display = str(display).lower() in ('1', 'true', 'yes')
+    name = '%s%s' % (re.sub(r'\.(pdb|ent)(\.gz)?$', '', os.path.basename(trajectory)), '_%s' % chain if chain else '')
+    radius = inconsistency_coefficient / 2.0
+    result_dir = os.path.join(output_dir, name)
+    if not os.path.exists(result_dir):
+        os.makedirs(result_dir)
+
+    # the query frame defines the superposition target and the hydration sites
+    for frame, (referenceCA, referenceWaters, referenceNumbers, lines) in enumerate(trajectoryFrames(trajectory, topology, chain)):
+        if frame == query_frame:
+            break
     else:
-        logger.info( "%s has only one PDB structure. We need atleast 2 structures to superimpose." % selectedPDBChain)
-    shutil.rmtree(tmp_dir)
+        logger.error( '%s has no frame %i.' % (trajectory, query_frame))
+        return None
+    if lines is None:
+        lines = trajectoryReferenceLines(trajectory, topology, chain, query_frame, result_dir)
+    waterLines = [line for line in lines if line[17:21].strip() in WATER_RESIDUES and line[12:16].strip() in WATER_OXYGENS]
+    proteinLines = [line for line in lines if line.startswith('ATOM') and (not chain or line[21] == chain)
+        and line[76:78].strip() != 'H' and line[17:21].strip() not in WATER_RESIDUES]
+    if len(referenceCA) < 3 or not len(referenceWaters):
+        logger.error( 'The query frame of %s has no protein chain or no water molecules.' % trajectory)
+        return None
+    proteinCoordinates = np.array([[float(line[30:38]), float(line[38:46]), float(line[46:54])] for line in proteinLines])
+    sites = np.flatnonzero(np.isfinite(cKDTree(proteinCoordinates).query(referenceWaters, distance_upper_bound=shell)[0]))
+    logger.info( '%i of %i water molecules of the query frame are within %s A of the protein.' % (len(sites), len(referenceWaters), shell))
+
+    def superimpose(block):
+        moved = []
+        for ca, waters, numbers in block:
+            if len(ca) != len(referenceCA):
+                raise ValueError('A frame of %s has %i instead of %i C-alpha atoms.' % (trajectory, len(ca), len(referenceCA)))
+            R, t = kabsch(ca, referenceCA)
+            moved.append(np.dot(waters, R.T) + t)
+        frameIndex = np.repeat(np.arange(len(block)), [len(waters) for waters in moved])
+        return np.concatenate(moved), frameIndex, np.concatenate([numbers for ca, waters, numbers in block])
+
+    def chunks(frames):
+        block = []
+        for ca, waters, numbers, lines in frames:
+            block.append((ca, waters, numbers))
+            if len(block) == chunk:
+                yield block
+                block = []
+        if block:
+            yield block
+
+    # a single frame places the sites with its thermal noise, so they are moved once to the mean
+    # position of their waters in the first chunk
+    centers = referenceWaters[sites]
+    for block in chunks(trajectoryFrames(trajectory, topology, chain, stride)):
+        coordinates, frameIndex, numbers = superimpose(block)
+        distances, nearest = cKDTree(centers).query(coordinates, distance_upper_bound=radius)
+        hit = np.isfinite(distances)
+        counts = np.bincount(nearest[hit], minlength=len(sites))
+        for axis in xrange(3):
+            centers[:, axis] = np.where(counts > 0, np.bincount(nearest[hit], coordinates[hit, axis], minlength=len(sites)) / np.maximum(counts, 1), centers[:, axis])
+        break
+    siteTree = cKDTree(centers)
+
+    start = time.time()
+    occupancy = np.zeros(len(sites), dtype=np.int64)
+    n_frames = 0
+    presencePath = os.path.join(result_dir, '%s_presence.int32' % name)
+    presenceOut = open(presencePath, 'wb')
+    for block in chunks(trajectoryFrames(trajectory, topology, chain, stride)):
+        coordinates, frameIndex, numbers = superimpose(block)
+        distances, nearest = siteTree.query(coordinates, distance_upper_bound=radius)
+        hit = np.isfinite(distances)
+        table = -np.ones((len(block), len(sites)), dtype=np.int32)
+        table[frameIndex[hit], nearest[hit]] = numbers[hit]
+        occupancy += (table != -1).sum(axis=0)
+        presenceOut.write(table.tobytes())
+        n_frames += len(block)
+        logger.info( '%i frames processed (%.0f frames/s).' % (n_frames, n_frames / max(time.time() - start, 1e-9)))
+    presenceOut.close()
+
+    degree = occupancy / float(n_frames)
+    conserved = np.flatnonzero(degree >= prob)
+    presence = np.memmap(presencePath, dtype=np.int32, mode='r', shape=(n_frames, len(sites)))
+    clusterPresenceOut = open(os.path.join(result_dir, '%s_clusterPresence.txt' % name), 'w')
+    clusterPresenceOut.write('Water Conservation Score'+'\t')
+    clusterPresenceOut.write(''.join('frame_%i\t' % (frame * stride) for frame in xrange(n_frames)))
+    clusterPresenceOut.write('\n')
+    # the columns of the conserved sites are transposed in blocks of at most 2**24 numbers,
+    # each read by one pass over the table
+    step = max((1 << 24) // n_frames, 1)
+    for first in xrange(0, len(conserved), step):
+        block = conserved[first:first + step]
+        for site, numbers in zip(block, np.array(presence[:, block]).T):
+            clusterPresenceOut.write(str(float(degree[site]))+'\t')
+            clusterPresenceOut.write('\t'.join(np.where(numbers == -1, 'NoWater', numbers.astype(str)))+'\t')
+            clusterPresenceOut.write('\n')
+    clusterPresenceOut.close()
+    del presence
+
+    atomNumbersProbDic = {}
+    conservedLines = []
+    for site in conserved:
+        atomNumbersProbDic[ str(referenceNumbers[sites[site]]) ] = float(degree[site])
+        conservedLines.append(waterLines[sites[site]])
+    logger.info( '%s has %i conserved water molecules in %i frames.' % (name, len(atomNumbersProbDic), n_frames))
+    # the query frame with all its waters, shown next to the conserved ones
+    queryOut = open(os.path.join(result_dir, 'cwm_%s.pdb' % name), 'w')
+    queryOut.write(''.join(proteinLines + [line for line in lines if line[17:21].strip() in WATER_RESIDUES]))
+    queryOut.write('END\n')
+    queryOut.close()
+    pdbOut = open(os.path.join(result_dir, 'cwm_%s_withConservedWaters.pdb' % name), 'w')
+    pdbOut.write(''.join(proteinLines + conservedLines))
+    pdbOut.write('END\n')
+    pdbOut.close()
+    if atomNumbersProbDic and display:
+        displayInPyMOL(result_dir, 'cwm_%s' % name, atomNumbersProbDic)
+    return atomNumbersProbDic
+
+
+def transferConservedWaters( sites, structure, chain, prob = None, output_dir = None, display = True ):
+    """
+        Transfer the conserved hydration sites of a family (xxxx_x_sites.npz of a PyWATER run) onto a new
+        or apo structure (a PDB file or a PDB id) without re-clustering the family: the chain is superimposed
+        onto the C-alpha trace of the family query (matched by residue number) and each of its waters is
+        assigned to the nearest site with a degree of conservation >= prob (default: that of the family
+        run) within half the inconsistency coefficient threshold, by one KD-tree query. Sites without a
+        water are predicted, in the frame of the structure.
+        Returns a dictionary of the conserved water numbers of the chain and their degree of conservation.
+    """
+    start = time.time()
+    output_dir = output_dir or outdir
+    chain = str(chain).upper()
+    display = str(display).lower() in ('1', 'true', 'yes')
+    family = np.load(sites)
+    prob = float(family['probability']) if prob is None or prob == '' else float(prob)
+    radius = float(family['distance']) / 2.0
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        if os.path.exists(structure):
+            pdbFile = structure
+        else:
+            pdbFile = retrieveStructure(str(structure).lower(), tmp_dir)
+        name = '%s_%s' % (re.sub(r'\.(pdb|ent)(\.gz)?$', '', os.path.basename(pdbFile)), chain)
+        lines = []
+        for line in readPDBLines(pdbFile):
+            if line.startswith('ENDMDL'):
+                break
+            if line.startswith(('ATOM', 'HETATM')) and line[21] == chain:
+                lines.append(line)
+        entry = parseChainsFromLines(lines, [chain]).get(chain)
+    finally:
+        shutil.rmtree(tmp_dir)
+    if entry is None or not len(entry['ca_residues']):
+        logger.error( '%s has no chain %s.' % (structure, chain))
+        return None
+    superposition = superposeCATraces(entry['ca_coordinates'], entry['ca_residues'], family['ca_coordinates'], family['ca_residues'])
+    if superposition is None:
+        logger.error( '%s could not be matched to %s by residue numbers, please run the family again.' % (name, family['query']))
+        return None
+    R, t, rmsd, n_aligned = superposition
+    logger.info( 'Superimposed %s onto %s (RMSD %.2f over %i C-alpha atoms)' % (name, family['query'], rmsd, n_aligned))
+
+    selected = np.flatnonzero(family['degrees'] >= prob - 1e-9)
+    centroids = family['centroids'][selected]
+    water = -np.ones(len(selected), dtype=np.int64)
+    distance = np.zeros(len(selected))
+    if len(entry['water_serials']) and len(selected):
+        waters = np.dot(entry['water_coordinates'].astype(float), R.T) + t
+        distances, nearest = cKDTree(centroids).query(waters, distance_upper_bound=radius)
+        # every site takes its closest water
+        order = np.argsort(distances)
+        order = order[np.isfinite(distances[order])]
+        matched, first = np.unique(nearest[order], return_index=True)
+        water[matched] = order[first]
+        distance[matched] = distances[order[first]]
+    occupied = water >= 0
+    atomNumbersProbDic = dict((str(entry['water_serials'][water[site]]), float(family['degrees'][selected[site]]))
+        for site in np.flatnonzero(occupied))
+    logger.info( '%s has %i of %i conserved sites (degree of conservation >= %s) occupied, %i sites are predicted (%.3f s).' % (name,
+        occupied.sum(), len(selected), prob, len(selected) - occupied.sum(), time.time() - start))
+
+    result_dir = os.path.join(output_dir, name)
+    if not os.path.exists(result_dir):
+        os.makedirs(result_dir)
+    chainOut = open(os.path.join(result_dir, 'cwm_%s.pdb' % name), 'w')
+    chainOut.write(''.join(lines) + 'END\n')
+    chainOut.close()
+    kept = set(atomNumbersProbDic)
+    conservedOut = open(os.path.join(result_dir, 'cwm_%s_withConservedWaters.pdb' % name), 'w')
+    conservedOut.write('REMARK 999 CONSERVED WATERS TRANSFERRED FROM %s\n' % family['query'])
+    for line in lines:
+        if line[17:20] in ('HOH', 'DOD', 'WAT'):
+            if line[12:16].strip().startswith('O') and str(int(line[22:26])) in kept:
+                conservedOut.write(line[:17] + 'HOH' + line[20:])
+        else:
+            conservedOut.write(line)
+    conservedOut.write('END\n')
+    conservedOut.close()
+
+    # predicted waters in the frame of the structure, occupancy: degree of conservation, B-factor: from the spread
+    predicted = np.flatnonzero(~occupied)
+    coordinates = np.dot(centroids[predicted] - t, R)
+    serial = max([int(line[6:11]) for line in lines if line[6:11].strip().isdigit()] + [0])
+    resi = max([int(line[22:26]) for line in lines] + [0])
+    predictedOut = open(os.path.join(result_dir, 'cwm_%s_predictedWaters.pdb' % name), 'w')
+    predictedOut.write('REMARK 999 PREDICTED WATERS TRANSFERRED FROM %s\n' % family['query'])
+    for number, (site, coordinate) in enumerate(zip(predicted, coordinates)):
+        bfactor = min(8 * np.pi ** 2 * family['spreads'][selected[site]] ** 2 / 3.0, 999.99)
+        predictedOut.write('HETATM%5i  O   HOH %s%4i    %8.3f%8.3f%8.3f%6.2f%6.2f           O\n' % ((serial + number + 1) % 100000,
+            chain, (resi + number + 1) % 10000, coordinate[0], coordinate[1], coordinate[2], family['degrees'][selected[site]], bfactor))
+    predictedOut.write('END\n')
+    predictedOut.close()
+
+    transferOut = open(os.path.join(result_dir, '%s_transfer.txt' % name), 'w')
+    transferOut.write('site\tdegree of conservation\tspread\t%s water\t%s water\tdistance\n' % (family['query'], name))
+    for site in xrange(len(selected)):
+        query_water = family['query_waters'][selected[site]]
+        transferOut.write('%i\t%.3f\t%.3f\t%s\t%s\t%s\n' % (selected[site], family['degrees'][selected[site]], family['spreads'][selected[site]],
+            query_water if query_water >= 0 else 'NoWater', entry['water_serials'][water[site]] if occupied[site] else 'predicted',
+            '%.2f' % distance[site] if occupied[site] else ''))
+    transferOut.close()
+    logger.info( 'Conserved and predicted waters of %s are saved in %s' % (name, result_dir))
+
+    if display:
+        with PYMOL_LOCK:
+            if atomNumbersProbDic:
+                displayInPyMOL(result_dir, 'cwm_%s' % name, atomNumbersProbDic)
+            if len(predicted):
+                cmd.delete('predicted_waters')
+                cmd.load(os.path.join(result_dir, 'cwm_%s_predictedWaters.pdb' % name), 'predicted_waters')
+                cmd.set('sphere_scale', 0.40, 'predicted_waters')
+                cmd.show_as('spheres', 'predicted_waters')
+                cmd.color('magenta', 'predicted_waters')
+    return atomNumbersProbDic
+
+
+BATCH_PARAMETERS = ('seq_id', 'resolution', 'refinement', 'clustering_method', 'inconsistency_coefficient',
+    'prob', 'atlas_dir', 'query_anchored', 'anchor_selection', 'index_dir')
+
+
+def writeJSONAtomic( path, data ):
+    """
+        Write a JSON file by renaming a complete temporary file, so readers never see a partial file.
+    """
+    tmp_path = '%s.%s-%s.tmp' % (path, socket.gethostname(), os.getpid())
+    with open(tmp_path, 'w') as handle:
+        json.dump(data, handle, indent=1, sort_keys=True)
+    os.rename(tmp_path, path)
+
+
+def makeBatchManifest( queries, batch_dir, shards = 1, seq_id = '95', resolution = 2.0, refinement = 'Mobility',
+        clustering_method = 'complete', inconsistency_coefficient = 2.4, prob = 0.7, atlas_dir = '',
+        query_anchored = False, anchor_selection = '', index_dir = '' ):
+    """
+        Create the job manifest of a batch run in batch_dir, a directory shared by all nodes.
+        queries is a list of pdb chains (xxxx_x) or a file with one pdb chain per line.
+        The queries are split round-robin into shards, one per node.
+    """
+    if not isinstance(queries, (list, tuple)):
+        queries = [line.split()[0] for line in open(queries) if line.strip()]
+    queries = ['%s_%s' % (query[:4].lower(), query[5:].upper()) for query in queries]
+    shards = int(shards)
+    for name in ('locks', 'results', 'done', 'failed', 'work'):
+        if not os.path.exists(os.path.join(batch_dir, name)):
+            os.makedirs(os.path.join(batch_dir, name))
+    manifest = {
+        'parameters': {
+            'seq_id': str(seq_id),
+            'resolution': float(resolution),
+            'refinement': str(refinement),
+            'clustering_method': str(clustering_method),
+            'inconsistency_coefficient': float(inconsistency_coefficient),
+            'prob': float(prob),
+            'atlas_dir': str(atlas_dir),
+            'query_anchored': str(query_anchored).lower() in ('1', 'true', 'yes'),
+            'anchor_selection': str(anchor_selection),
+            'index_dir': str(index_dir),
+        },
+        'shards': [queries[shard::shards] for shard in xrange(shards)],
+    }
+    writeJSONAtomic(os.path.join(batch_dir, 'manifest.json'), manifest)
+    logger.info( 'Batch manifest with %i queries in %i shards is saved in %s' % (len(queries), shards, batch_dir))
+    return manifest
+
+
+def runBatchQuery( query, parameters, output_dir ):
+    """
+        Find the conserved waters of one query of a batch run without displaying them.
+    """
+    pdb_id, chain = query.split('_')
+    return FindConservedWaters(pdb_id, chain, parameters['seq_id'], parameters['resolution'],
+        parameters['refinement'], '', parameters['clustering_method'], parameters['inconsistency_coefficient'],
+        parameters['prob'], save_sup_files=False, atlas_dir=parameters['atlas_dir'],
+        query_anchored=parameters['query_anchored'], anchor_selection=parameters['anchor_selection'],
+        output_dir=output_dir, display=False, index_dir=parameters.get('index_dir', ''))
+
+
+def deadLocalProcess( node ):
+    """
+        Check whether a node named hostname-pid is a process of this host which is not running.
+    """
+    host, _, pid = node.rpartition('-')
+    if host != socket.gethostname() or not pid.isdigit():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except OSError as e:
+        return e.errno == errno.ESRCH
+    return False
+
+
+def claimQuery( batch_dir, query, node, stale ):
+    """
+        Claim a query with an exclusively created lock file. Locks older than stale seconds
+        or of a process on this host which is not running any more are taken to be left over
+        by a crashed node and are broken.
+    """
+    lock = os.path.join(batch_dir, 'locks', '%s.lock' % query)
+    try:
+        fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except OSError:
+        try:
+            age = time.time() - os.path.getmtime(lock)
+        except OSError:
+            return False
+        try:
+            owner = open(lock).read().split()[0]
+        except (OSError, IOError, IndexError):
+            # empty or partly written by a node which crashed right after creating it
+            owner = None
+        if age < stale and (owner is None or not deadLocalProcess(owner)):
+            return False
+        # rename first, so that only one node breaks the stale lock
+        broken = '%s.%s.stale' % (lock, node)
+        try:
+            os.rename(lock, broken)
+        except OSError:
+            return False
+        os.remove(broken)
+        logger.warning( 'Broke the stale lock of %s (%i s old).' % (query, age))
+        if not claimQuery(batch_dir, query, node, stale):
+            return False
+        # work directories left over by the crashed node, removed once the query is claimed again
+        for work_dir in glob.glob(os.path.join(batch_dir, 'work', '%s.*' % query)):
+            shutil.rmtree(work_dir, ignore_errors=True)
+        return True
+    os.write(fd, ('%s %s\n' % (node, time.time())).encode('ascii'))
+    os.close(fd)
+    return True
+
+
+def runBatch( batch_dir, shard = 0, node = '', stale = 86400, retry_failed = False, runner = None ):
+    """
+        Work through the manifest of batch_dir, starting with the queries of the own shard and
+        then taking over unclaimed queries of other shards. Every query is claimed with a lock
+        file; its outputs are moved to results/ and a checkpoint is written to done/ atomically,
+        so an interrupted run resumes where it stopped. Several nodes (or local processes) can
+        run on the same batch_dir at the same time.
+        Returns the number of queries processed by this node.
+    """
+    manifest = json.load(open(os.path.join(batch_dir, 'manifest.json')))
+    node = node or '%s-%s' % (socket.gethostname(), os.getpid())
+    shard = int(shard)
+    stale = float(stale)
+    retry_failed = str(retry_failed).lower() in ('1', 'true', 'yes')
+    runner = runner or runBatchQuery
+    shards = manifest['shards']
+    queries = []
+    for offset in xrange(len(shards)):
+        queries += shards[(shard + offset) % len(shards)]
+    processed = 0
+    for query in queries:
+        done = os.path.join(batch_dir, 'done', '%s.json' % query)
+        failed = os.path.join(batch_dir, 'failed', '%s.json' % query)
+        if os.path.exists(done) or (os.path.exists(failed) and not retry_failed):
+            continue
+        if not claimQuery(batch_dir, query, node, stale):
+            continue
+        try:
+            # another node may have finished the query between the check and the claim
+            if os.path.exists(done):
+                continue
+            logger.info( '%s is processing %s' % (node, query))
+            work_dir = os.path.join(batch_dir, 'work', '%s.%s' % (query, node))
+            if os.path.exists(work_dir):
+                shutil.rmtree(work_dir)
+            os.makedirs(work_dir)
+            start = time.time()
+            try:
+                atomNumbersProbDic = runner(query, manifest['parameters'], work_dir)
+            except Exception as e:
+                logger.error( '%s failed on %s: %s' % (node, query, e))
+                shutil.rmtree(work_dir, ignore_errors=True)
+                writeJSONAtomic(failed, {'query': query, 'node': node, 'error': str(e), 'finished': time.time()})
+                continue
+            result_dir = os.path.join(batch_dir, 'results', query)
+            if os.path.exists(result_dir):
+                shutil.rmtree(result_dir)
+            os.rename(work_dir, result_dir)
+            writeJSONAtomic(done, {
+                'query': query,
+                'node': node,
+                'status': 'ok' if atomNumbersProbDic is not None else 'no result',
+                'conserved_waters': atomNumbersProbDic or {},
+                'result_dir': os.path.relpath(result_dir, batch_dir),
+                'seconds': time.time() - start,
+                'finished': time.time(),
+            })
+            if os.path.exists(failed):
+                os.remove(failed)
+            processed += 1
+        finally:
+            os.remove(os.path.join(batch_dir, 'locks', '%s.lock' % query))
+    logger.info( '%s processed %i queries.' % (node, processed))
+    return processed
+
+
+def mergeBatch( batch_dir, index_file = '' ):
+    """
+        Merge the checkpoints of all finished queries of a batch run into one tab separated
+        index of query, water number, degree of conservation and result folder.
+        Returns the number of finished queries.
+    """
+    manifest = json.load(open(os.path.join(batch_dir, 'manifest.json')))
+    index_file = index_file or os.path.join(batch_dir, 'conserved_waters_index.tsv')
+    queries = [query for shard in manifest['shards'] for query in shard]
+    finished = missing = 0
+    indexOut = open(index_file + '.tmp', 'w')
+    indexOut.write('query\twater number\tdegree of conservation\tresult folder\n')
+    for query in sorted(queries):
+        done = os.path.join(batch_dir, 'done', '%s.json' % query)
+        if not os.path.exists(done):
+            missing += 1
+            continue
+        checkpoint = json.load(open(done))
+        finished += 1
+        waters = checkpoint['conserved_waters']
+        for water in sorted(waters, key=lambda number: int(number)):
+            indexOut.write('%s\t%s\t%s\t%s\n' % (query, water, waters[water], checkpoint['result_dir']))
+    indexOut.close()
+    os.rename(index_file + '.tmp', index_file)
+    failed = len(glob.glob(os.path.join(batch_dir, 'failed', '*.json')))
+    logger.info( 'Merged %i finished queries into %s, %i queries are missing (%i failed).' % (finished, index_file, missing, failed))
+    return finished
+
+
+SERVICE_PARAMETERS = {
+    'seq_id': str, 'resolution': float, 'refinement': str, 'user_def_list': str, 'clustering_method': str,
+    'inconsistency_coefficient': float, 'prob': float, 'atlas_dir': str, 'query_anchored': bool,
+    'anchor_selection': str, 'confidence': str, 'resamples': int, 'stability': float, 'n_procs': int,
+    'map_spacing': float, 'map_extent': float,
+}
+
+# ranges the resources of a single job are clamped to
+SERVICE_LIMITS = {'n_procs': (1, multiprocessing.cpu_count()), 'resamples': (1, 10000),
+    'map_spacing': (0.5, 2.0), 'map_extent': (0.0, 20.0)}
+
+# the stages whose reuse counts as a hit of the warm caches of the service
+SERVICE_CACHES = (('metadata', ('members', 'metadata')), ('structures', ('downloads',)),
+    ('transforms', ('superposition',)), ('results', ('refinement', 'density', 'clustering', 'extraction')))
+
+
+class PyWATERService():
+    """
+        Long-running PyWATER which keeps PyMOL, the local PDB index and the stage results warm between
+        jobs. Jobs are queued (at most max_queue) and run by max_jobs worker threads; the stages using
+        PyMOL take turns, the others (web services, downloads, clustering) run concurrently.
+        All jobs share one StageCache work directory whose results are also kept in memory, so the
+        members and metadata (metadata cache), downloads (structure cache) and superposition
+        (transform cache) stages of a family are computed once. The members and resolutions in the
+        PDB change weekly, so the metadata cache expires after expiry seconds (0: never).
+    """
+    def __init__(self, work_dir = '', output_dir = '', index_dir = '', max_jobs = 2, max_queue = 100, n_procs = 1, keep = 1000, expiry = 86400):
+        self.work_dir = work_dir or os.path.join(outdir, 'service', 'work')
+        self.output_dir = output_dir or os.path.join(outdir, 'service', 'jobs')
+        self.index_dir = index_dir
+        self.max_jobs = int(max_jobs)
+        self.n_procs = int(n_procs)
+        self.keep = int(keep)
+        self.expiry = float(expiry)
+        for path in (self.work_dir, self.output_dir):
+            if not os.path.exists(path):
+                os.makedirs(path)
+        self.queue = Queue.Queue(int(max_queue))
+        # stage results, the oldest are dropped beyond keep
+        self.memory = collections.OrderedDict()
+        self.jobs = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.latencies = collections.deque(maxlen=1000)
+        self.hits = dict((stage, [0, 0]) for name, stages in SERVICE_CACHES for stage in stages)
+        self.workers = []
+        if index_dir:
+            # load the index before the first job
+            index = openPDBIndex(index_dir)
+            index.entries()
+
+    def start(self):
+        for number in xrange(self.max_jobs):
+            worker = threading.Thread(target=self.work, name='pywater-worker-%i' % number)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def stop(self):
+        for worker in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+    def submit(self, request):
+        """
+            Queue a job for the query request['pdb'], request['chain'] with the parameters of
+            FindConservedWaters in SERVICE_PARAMETERS. Returns the job, or raises ValueError for
+            an invalid request and Queue.Full if the queue is full.
+        """
+        pdb_id = str(request.get('pdb', '')).lower()
+        chain = str(request.get('chain', '')).upper()
+        if not re.match('^[0-9][a-z0-9]{3}$', pdb_id) or not re.match('^[A-Z0-9]$', chain):
+            raise ValueError('A 4 character PDB id and a 1 character chain id are required.')
+        parameters = {'seq_id': '95', 'resolution': 2.0, 'refinement': 'Mobility', 'user_def_list': '',
+            'clustering_method': 'complete', 'inconsistency_coefficient': 2.4, 'prob': 0.7, 'atlas_dir': '',
+            'query_anchored': False, 'anchor_selection': '', 'confidence': '', 'resamples': 1000,
+            'stability': 0.0, 'n_procs': self.n_procs, 'map_spacing': 0.0, 'map_extent': 5.0}
+        for name, value in request.items():
+            if name in ('pdb', 'chain'):
+                continue
+            if name not in SERVICE_PARAMETERS:
+                raise ValueError('Unknown parameter: %s' % name)
+            if SERVICE_PARAMETERS[name] is bool:
+                parameters[name] = str(value).lower() in ('1', 'true', 'yes')
+            else:
+                try:
+                    parameters[name] = SERVICE_PARAMETERS[name](value)
+                except ValueError:
+                    raise ValueError('Invalid value of %s: %s' % (name, value))
+                if SERVICE_PARAMETERS[name] is float and not np.isfinite(parameters[name]):
+                    raise ValueError('Invalid value of %s: %s' % (name, value))
+        # the checks of FindConservedWaters, which would only fail the job
+        if parameters['seq_id'] not in SEQUENCE_IDENTITIES:
+            raise ValueError('seq_id must be one of %s' % ', '.join(SEQUENCE_IDENTITIES))
+        if parameters['resolution'] > 3.0 or parameters['resolution'] <= 0:
+            raise ValueError('The resolution cutoff is allowed from 0 to 3.0 A.')
+        if parameters['refinement'] not in REFINEMENT_METHODS:
+            raise ValueError('refinement must be one of %s' % ', '.join(REFINEMENT_METHODS))
+        if parameters['user_def_list']:
+            chains = parameters['user_def_list'].split(',')
+            if len(chains) < 2 or not all(re.match('^[a-zA-Z0-9]{4}_[a-zA-Z0-9]$', name) for name in chains):
+                raise ValueError('user_def_list needs at least two pdb chains identifier in the format: xxxx_x,yyyy_y,zzzz_z')
+        if parameters['clustering_method'] not in CLUSTERING_METHODS:
+            raise ValueError('clustering_method must be one of %s' % ', '.join(CLUSTERING_METHODS))
+        if parameters['confidence'] and parameters['confidence'] not in CONFIDENCE_METHODS:
+            raise ValueError('confidence must be one of %s' % ', '.join(CONFIDENCE_METHODS))
+        if parameters['stability'] and parameters['confidence'] == 'jackknife':
+            raise ValueError('The stability selection needs bootstrap resampling.')
+        if parameters['inconsistency_coefficient'] > 2.8 or parameters['inconsistency_coefficient'] <= 0:
+            raise ValueError('The inconsistency coefficient threshold is allowed from 0 to 2.8 A.')
+        if parameters['prob'] > 1.0 or parameters['prob'] < 0.4:
+            raise ValueError('The degree of conservation is allowed from 0.4 to 1.0.')
+        if parameters['stability'] > 1.0 or parameters['stability'] < 0:
+            raise ValueError('The stability threshold is allowed from 0 to 1.0.')
+        for name, (lower, upper) in SERVICE_LIMITS.items():
+            if name != 'map_spacing' or parameters[name] > 0:
+                parameters[name] = min(max(parameters[name], lower), upper)
+        with self.lock:
+            # unique across restarts of the service sharing the output directory
+            job = {'id': uuid.uuid4().hex[:12], 'query': '%s_%s' % (pdb_id, chain), 'parameters': parameters,
+                'status': 'queued', 'submitted': time.time(), 'started': None, 'finished': None, 'error': None,
+                'conserved_waters': None, 'reused': [], 'computed': []}
+            self.queue.put_nowait(job)
+            self.jobs[job['id']] = job
+            finished = [key for key, other in self.jobs.items() if other['status'] in ('done', 'failed')]
+            for key in finished[:max(len(self.jobs) - self.keep, 0)]:
+                del self.jobs[key]
+        logger.info( 'Job %s queued: %s' % (job['id'], job['query']))
+        return job
+
+    def work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            try:
+                self.run(job)
+            except Exception as e:
+                # keep the worker alive
+                logger.error( 'Job %s (%s) failed: %s' % (job['id'], job['query'], e))
+                job['error'] = job['error'] or str(e) or e.__class__.__name__
+                job['status'] = 'failed'
+                job['finished'] = job['finished'] or time.time()
+
+    def run(self, job):
+        job['status'] = 'running'
+        job['started'] = time.time()
+        job['output_dir'] = os.path.join(self.output_dir, job['id'])
+        parameters = job['parameters']
+        expiry = dict((stage, self.expiry) for stage in dict(SERVICE_CACHES)['metadata']) if self.expiry > 0 else None
+        cache = StageCache(self.work_dir, self.memory, expiry)
+        pdb_id, chain = job['query'].split('_')
+        try:
+            if not os.path.exists(job['output_dir']):
+                os.makedirs(job['output_dir'])
+            result = FindConservedWaters(pdb_id, chain, parameters['seq_id'], parameters['resolution'],
+                parameters['refinement'], parameters['user_def_list'], parameters['clustering_method'],
+                parameters['inconsistency_coefficient'], parameters['prob'], save_sup_files=False,
+                atlas_dir=parameters['atlas_dir'], query_anchored=parameters['query_anchored'],
+                anchor_selection=parameters['anchor_selection'], output_dir=job['output_dir'], display=False,
+                index_dir=self.index_dir, confidence=parameters['confidence'], resamples=parameters['resamples'],
+                stability=parameters['stability'], n_procs=parameters['n_procs'], cache=cache,
+                map_spacing=parameters['map_spacing'], map_extent=parameters['map_extent'])
+            if result is None:
+                raise RuntimeError('No prediction could be made, see pywater.log.')
+            job['conserved_waters'] = result
+            job['status'] = 'done'
+        except Exception as e:
+            logger.error( 'Job %s (%s) failed: %s' % (job['id'], job['query'], e))
+            job['error'] = str(e) or e.__class__.__name__
+            job['status'] = 'failed'
+        job['finished'] = time.time()
+        job['reused'], job['computed'] = cache.reused, cache.computed
+        with self.lock:
+            # stages outside SERVICE_CACHES are not counted
+            for stage in cache.reused:
+                if stage in self.hits:
+                    self.hits[stage][0] += 1
+            for stage in cache.computed:
+                if stage in self.hits:
+                    self.hits[stage][1] += 1
+            self.latencies.append((job['started'] - job['submitted'], job['finished'] - job['started']))
+            while len(self.memory) > self.keep:
+                self.memory.popitem(last=False)
+        logger.info( 'Job %s %s in %.2f s.' % (job['id'], job['status'], job['finished'] - job['started']))
+
+    def status(self, job):
+        return dict((name, job.get(name)) for name in ('id', 'query', 'parameters', 'status', 'submitted',
+            'started', 'finished', 'error', 'reused', 'computed'))
+
+    def result(self, job):
+        """
+            The conserved waters of a finished job and the query structure with its conserved waters.
+        """
+        result = {'id': job['id'], 'query': job['query'], 'conserved_waters': job['conserved_waters'], 'files': {}}
+        result_dir = os.path.join(job['output_dir'], job['query'])
+        for path in sorted(glob.glob(os.path.join(result_dir, '*'))):
+            if path.endswith('_withConservedWaters.pdb'):
+                result['pdb'] = open(path).read()
+            result['files'][os.path.basename(path)] = path
+        return result
+
+    def stats(self):
+        """
+            Job counts, queueing and run time latencies (mean, median, 95th percentile and maximum in s)
+            of the last jobs, and the hit rates of the warm caches.
+        """
+        with self.lock:
+            counts = collections.Counter(job['status'] for job in self.jobs.values())
+            latencies = np.array(self.latencies, dtype=float).reshape(-1, 2)
+            hits = copy.deepcopy(self.hits)
+        stats = {'uptime': time.time() - self.started, 'jobs': dict(counts), 'queue': self.queue.qsize(),
+            'workers': self.max_jobs, 'latency': {}, 'caches': {}}
+        for column, name in enumerate(('queued', 'run')):
+            if len(latencies):
+                values = latencies[:, column]
+                stats['latency'][name] = {'mean': values.mean(), 'median': np.median(values),
+                    'p95': np.percentile(values, 95), 'max': values.max(), 'jobs': len(values)}
+        for name, stages in SERVICE_CACHES:
+            hit = sum(hits[stage][0] for stage in stages)
+            miss = sum(hits[stage][1] for stage in stages)
+            stats['caches'][name] = {'hits': hit, 'misses': miss, 'hit_rate': float(hit) / (hit + miss) if hit + miss else None}
+        return stats
+
+
+class ServiceRequestHandler( BaseHTTPRequestHandler ):
+    """
+        Local JSON API of the PyWATERService in self.server.service:
+            POST /jobs                 queue a job, e.g. {"pdb": "1hai", "chain": "H", "prob": 0.7}
+            GET  /jobs                 status of all jobs
+            GET  /jobs/<id>            status of a job
+            GET  /jobs/<id>/result     conserved waters of a finished job
+            GET  /stats                latencies and cache hit rates
+    """
+    def reply(self, code, data):
+        body = json.dumps(data, indent=1, sort_keys=True).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        service = self.server.service
+        parts = [part for part in self.path.split('?')[0].split('/') if part]
+        if parts == ['stats']:
+            return self.reply(200, service.stats())
+        # the workers add and remove jobs
+        with service.lock:
+            jobs = list(service.jobs.values())
+            job = service.jobs.get(parts[1]) if len(parts) in (2, 3) and parts[0] == 'jobs' else None
+        if parts == ['jobs']:
+            return self.reply(200, [service.status(job) for job in jobs])
+        if job is not None:
+            if len(parts) == 2:
+                return self.reply(200, service.status(job))
+            if parts[2] == 'result':
+                if job['status'] == 'done':
+                    return self.reply(200, service.result(job))
+                if job['status'] == 'failed':
+                    return self.reply(500, service.status(job))
+                return self.reply(409, service.status(job))
+        self.reply(404, {'error': 'Not found: %s' % self.path})
+
+    def do_POST(self):
+        service = self.server.service
+        if self.path.split('?')[0].rstrip('/') != '/jobs':
+            return self.reply(404, {'error': 'Not found: %s' % self.path})
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8'))
+            if not isinstance(request, dict):
+                raise ValueError('The request must be a JSON object.')
+            job = service.submit(request)
+        except ValueError as e:
+            return self.reply(400, {'error': str(e)})
+        except Queue.Full:
+            return self.reply(503, {'error': 'The job queue is full.'})
+        self.reply(202, service.status(job))
+
+    def log_message(self, format, *args):
+        logger.debug( 'Service request from %s: %s' % (self.client_address[0], format % args))
+
+
+class ServiceHTTPServer( ThreadingMixIn, HTTPServer ):
+    daemon_threads = True
+
+
+def runService( port = 8765, host = '127.0.0.1', work_dir = '', index_dir = '', max_jobs = 2, max_queue = 100, n_procs = 1, expiry = 86400 ):
+    """
+        Run PyWATER as a service answering the API of ServiceRequestHandler on host:port until it is
+        interrupted. It only listens on the local host unless another host is given.
+    """
+    service = PyWATERService(work_dir, index_dir = index_dir, max_jobs = max_jobs, max_queue = max_queue, n_procs = n_procs, expiry = expiry)
+    server = ServiceHTTPServer((host, int(port)), ServiceRequestHandler)
+    server.service = service
+    service.start()
+    logger.info( 'PyWATER service listening on http://%s:%i with %i workers, stages are kept in %s' % (host, int(port), service.max_jobs, service.work_dir))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.stop()
+        logger.info( 'PyWATER service stopped.' )
+    return service.stats()
 
 
 class ConservedWaters( Frame ):
@@ -919,7 +3339,7 @@ class ConservedWaters( Frame ):
         Button(frame1,text=" Help  ",command=clustering_method_help).grid(row=6, column=2, sticky=W)
         v7 = StringVar(master=frame1)
         v7.set("complete")
-        OptionMenu(frame1, v7, 'complete', 'average', 'single').grid(row=6, column=1, sticky=W)
+        OptionMenu(frame1, v7, *CLUSTERING_METHODS).grid(row=6, column=1, sticky=W)
 
         Label(frame1, text="Inconsistency coefficient threshold").grid(row=7, column=0, sticky=W)
         Button(frame1,text=" Help  ",command=inconsistency_coefficient_help).grid(row=7, column=2, sticky=W)
@@ -957,7 +3377,7 @@ class ConservedWaters( Frame ):
             ).grid(row=1, column=1, sticky=W)
 
 
-def toPyWATER( v1, v2, v3 = '95', v4 = 2.0, v5 = 'Mobility', v6 = '', v7 = 'complete', v8 = 2.0, v9 = 0.7):
+def toPyWATER( v1, v2, v3 = '95', v4 = 2.0, v5 = 'Mobility', v6 = '', v7 = 'complete', v8 = 2.0, v9 = 0.7, atlas_dir = '', query_anchored = 0, anchor_selection = '', work_dir = '', index_dir = '', progressive = 0, confidence = '', resamples = 1000, stability = 0.0, n_procs = 1, map_spacing = 0.0, map_extent = 5.0):
     """
         Convert data types of input parameters given by command line.
     """
@@ -970,7 +3390,7 @@ def toPyWATER( v1, v2, v3 = '95', v4 = 2.0, v5 = 'Mobility', v6 = '', v7 = 'comp
     clustering_method = str(v7)
     inconsistency_coefficient = float(v8)
     prob = float(v9)
-    FindConservedWaters(selectedStruturePDB,selectedStrutureChain,seq_id,resolution,refinement,user_def_list,clustering_method,inconsistency_coefficient,prob)
+    FindConservedWaters(selectedStruturePDB,selectedStrutureChain,seq_id,resolution,refinement,user_def_list,clustering_method,inconsistency_coefficient,prob,atlas_dir=str(atlas_dir),query_anchored=str(query_anchored).lower() in ('1', 'true', 'yes'),anchor_selection=str(anchor_selection),work_dir=str(work_dir),index_dir=str(index_dir),progressive=int(progressive),confidence=str(confidence),resamples=int(resamples),stability=float(stability),n_procs=int(n_procs),map_spacing=float(map_spacing),map_extent=float(map_extent))
 
 
 def main(parent=None):
@@ -980,6 +3400,16 @@ def main(parent=None):
 
 #Extends PyMOL API to use this tool from command line.
 cmd.extend('pywater', toPyWATER)
+cmd.extend('pywater_atlas', buildWaterAtlas)
+cmd.extend('pywater_index', buildPDBIndex)
+cmd.extend('pywater_trajectory', FindConservedWatersInTrajectory)
+cmd.extend('pywater_transfer', transferConservedWaters)
+cmd.extend('pywater_compare_clustering', benchmarkClusteringAgreement)
+cmd.extend('pywater_benchmark', benchmarkScaling)
+cmd.extend('pywater_batch_manifest', makeBatchManifest)
+cmd.extend('pywater_batch', runBatch)
+cmd.extend('pywater_batch_merge', mergeBatch)
+cmd.extend('pywater_server', runService)
 
 
 if __name__ == '__main__':
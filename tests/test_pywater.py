@@ -0,0 +1,198 @@
+"""
+    Checks of the PyMOL-free parts of pywater.py. pywater.py is a PyMOL plugin and imports
+    pymol.cmd, so these tests need PyMOL installed (e.g. conda install pymol-open-source).
+"""
+import os
+import sys
+
+import pytest
+
+pytest.importorskip('pymol')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pywater
+
+
+def pdbLine(record, serial, name, resn, chain, resi, x, y, z, tail=''):
+    return '%-6s%5i %-4s %3s %s%4i    %8.3f%8.3f%8.3f%s\n' % (record, serial, name, resn, chain, resi, x, y, z, tail)
+
+
+def test_parse_chains_from_lines():
+    lines = [
+        pdbLine('ATOM', 1, 'N', 'ALA', 'A', 1, 0.0, 0.0, 0.0, '  1.00 10.00           N'),
+        pdbLine('ATOM', 2, 'CA', 'ALA', 'A', 1, 1.0, 0.0, 0.0, '  1.00 10.00           C'),
+        pdbLine('ATOM', 3, 'CA', 'GLY', 'B', 1, 5.0, 0.0, 0.0, '  1.00 10.00           C'),
+        pdbLine('HETATM', 4, 'O', 'HOH', 'A', 201, 2.0, 3.0, 4.0, '  0.50 20.00           O'),
+        pdbLine('HETATM', 5, 'H1', 'HOH', 'A', 201, 2.5, 3.0, 4.0, '  0.50 20.00           H'),
+        pdbLine('HETATM', 6, 'O', 'DOD', 'A', 202, 6.0, 7.0, 8.0, '  1.00 30.00           O'),
+        'ENDMDL\n',
+        pdbLine('HETATM', 7, 'O', 'HOH', 'A', 203, 9.0, 9.0, 9.0, '  1.00 30.00           O'),
+    ]
+    parsed = pywater.parseChainsFromLines(lines)
+    assert sorted(parsed) == ['A', 'B']
+    chain = parsed['A']
+    assert chain['ca_residues'].tolist() == [1]
+    # hydrogens are skipped, DOD is read as water and only the first model is read
+    assert chain['water_serials'].tolist() == [201, 202]
+    assert chain['occupancies'].tolist() == [0.5, 1.0]
+    assert chain['bfactors'].tolist() == [20.0, 30.0]
+    assert chain['water_coordinates'].shape == (2, 3)
+    assert list(pywater.parseChainsFromLines(lines, ['B'])) == ['B']
+
+
+def test_parse_chains_from_lines_blank_fields():
+    lines = [
+        pdbLine('ATOM', 1, 'CA', 'ALA', 'A', 1, 1.0, 0.0, 0.0, '                          C'),
+        pdbLine('HETATM', 2, 'O', 'HOH', 'A', 201, 2.0, 3.0, 4.0, '      '),
+        pdbLine('HETATM', 3, 'O', 'HOH', 'A', 202, 2.0, 3.0, 4.0),
+    ]
+    chain = pywater.parseChainsFromLines(lines)['A']
+    assert chain['occupancies'].tolist() == [1.0, 1.0]
+    assert chain['bfactors'].tolist() == [0.0, 0.0]
+
+
+def test_parse_chains_from_pdb(tmp_path):
+    path = tmp_path / 'test.pdb'
+    path.write_text(pdbLine('HETATM', 1, 'O', 'HOH', 'C', 7, 1.0, 2.0, 3.0, '  1.00 12.00           O'))
+    assert pywater.parseChainsFromPDB(str(path))['C']['water_serials'].tolist() == [7]
+
+
+def test_stage_cache_reuse_and_invalidation(tmp_path):
+    calls = []
+
+    def compute(stage_dir):
+        calls.append(stage_dir)
+        open(os.path.join(stage_dir, 'artifact.txt'), 'w').write('x')
+        return {'n': len(calls)}
+
+    cache = pywater.StageCache(str(tmp_path))
+    key, result, stage_dir = cache.run('members', {'query': '1hai_H'}, '', compute)
+    assert result == {'n': 1}
+    assert os.path.exists(os.path.join(stage_dir, 'stage.json'))
+    assert os.path.exists(os.path.join(stage_dir, 'artifact.txt'))
+    # same parameters and upstream: reused from disk, also by a new cache
+    again = pywater.StageCache(str(tmp_path))
+    assert again.run('members', {'query': '1hai_H'}, '', compute) == (key, {'n': 1}, stage_dir)
+    assert again.reused == ['members'] and len(calls) == 1
+    # a changed parameter or upstream key recomputes
+    assert cache.run('members', {'query': '1hai_L'}, '', compute)[0] != key
+    assert cache.run('members', {'query': '1hai_H'}, 'other', compute)[0] != key
+    assert len(calls) == 3
+    assert cache.computed == ['members'] * 3
+
+
+def test_stage_cache_failed_stage_leaves_no_checkpoint(tmp_path):
+    def fail(stage_dir):
+        raise RuntimeError('failed')
+
+    cache = pywater.StageCache(str(tmp_path))
+    with pytest.raises(RuntimeError):
+        cache.run('clustering', {}, '', fail)
+    assert os.listdir(os.path.join(str(tmp_path), 'clustering')) == []
+    assert cache.run('clustering', {}, '', lambda stage_dir: 1)[1] == 1
+
+
+def test_stage_cache_memory_and_expiry(tmp_path, monkeypatch):
+    memory = {}
+    cache = pywater.StageCache(str(tmp_path), memory, {'metadata': 100})
+    now = [1000.0]
+    monkeypatch.setattr(pywater.time, 'time', lambda: now[0])
+    key, result, stage_dir = cache.run('metadata', {}, '', lambda stage_dir: [1, 2])
+    assert memory[stage_dir] == [1, 2]
+    # results from memory are copies
+    cache.run('metadata', {}, '', None)[1].append(3)
+    assert cache.run('metadata', {}, '', None)[1] == [1, 2]
+    # a new key once the period expired
+    now[0] += 100
+    assert cache.run('metadata', {}, '', lambda stage_dir: [4])[0] != key
+
+
+def makeBatchDir(tmp_path):
+    batch_dir = str(tmp_path)
+    for name in ('locks', 'work'):
+        os.makedirs(os.path.join(batch_dir, name))
+    return batch_dir
+
+
+def test_claim_query_is_exclusive(tmp_path):
+    batch_dir = makeBatchDir(tmp_path)
+    assert pywater.claimQuery(batch_dir, '1hai_H', 'node1', 3600)
+    assert not pywater.claimQuery(batch_dir, '1hai_H', 'node2', 3600)
+    assert open(os.path.join(batch_dir, 'locks', '1hai_H.lock')).read().split()[0] == 'node1'
+
+
+def test_claim_query_breaks_stale_locks(tmp_path):
+    batch_dir = makeBatchDir(tmp_path)
+    lock = os.path.join(batch_dir, 'locks', '1hai_H.lock')
+    open(lock, 'w').write('otherhost-1 0\n')
+    os.makedirs(os.path.join(batch_dir, 'work', '1hai_H.otherhost-1'))
+    assert not pywater.claimQuery(batch_dir, '1hai_H', 'node1', 3600)
+    os.utime(lock, (0, 0))
+    assert pywater.claimQuery(batch_dir, '1hai_H', 'node1', 3600)
+    assert open(lock).read().split()[0] == 'node1'
+    # the work directory of the crashed node is removed
+    assert os.listdir(os.path.join(batch_dir, 'work')) == []
+
+
+def test_claim_query_breaks_empty_stale_locks(tmp_path):
+    batch_dir = makeBatchDir(tmp_path)
+    lock = os.path.join(batch_dir, 'locks', '1hai_H.lock')
+    open(lock, 'w').close()
+    assert not pywater.claimQuery(batch_dir, '1hai_H', 'node1', 3600)
+    os.utime(lock, (0, 0))
+    assert pywater.claimQuery(batch_dir, '1hai_H', 'node1', 3600)
+
+
+def test_claim_query_breaks_locks_of_dead_local_processes(tmp_path):
+    batch_dir = makeBatchDir(tmp_path)
+    lock = os.path.join(batch_dir, 'locks', '1hai_H.lock')
+    # a live process of this host keeps its lock, a pid which is not running does not
+    open(lock, 'w').write('%s-%i 0\n' % (pywater.socket.gethostname(), os.getpid()))
+    assert not pywater.claimQuery(batch_dir, '1hai_H', 'node1', 3600)
+    open(lock, 'w').write('%s-%i 0\n' % (pywater.socket.gethostname(), 2 ** 22 + 1))
+    assert pywater.claimQuery(batch_dir, '1hai_H', 'node1', 3600)
+
+
+@pytest.fixture
+def service(tmp_path):
+    # the workers are not started, submitted jobs stay queued
+    return pywater.PyWATERService(str(tmp_path / 'work'), str(tmp_path / 'jobs'), max_queue=2)
+
+
+@pytest.mark.parametrize('request_', [
+    {'pdb': 'xx', 'chain': 'A'},
+    {'pdb': '1hai', 'chain': 'HH'},
+    {'pdb': '1hai', 'chain': 'H', 'foo': 1},
+    {'pdb': '1hai', 'chain': 'H', 'prob': 'nan'},
+    {'pdb': '1hai', 'chain': 'H', 'prob': 0.3},
+    {'pdb': '1hai', 'chain': 'H', 'prob': 'high'},
+    {'pdb': '1hai', 'chain': 'H', 'resolution': -1},
+    {'pdb': '1hai', 'chain': 'H', 'resolution': 'inf'},
+    {'pdb': '1hai', 'chain': 'H', 'inconsistency_coefficient': 3},
+    {'pdb': '1hai', 'chain': 'H', 'stability': 1.5},
+    {'pdb': '1hai', 'chain': 'H', 'stability': 0.8, 'confidence': 'jackknife'},
+    {'pdb': '1hai', 'chain': 'H', 'user_def_list': '1hai_H'},
+    {'pdb': '1hai', 'chain': 'H', 'user_def_list': '1hai_H,1ppb'},
+    {'pdb': '1hai', 'chain': 'H', 'refinement': 'None'},
+    {'pdb': '1hai', 'chain': 'H', 'clustering_method': 'ward'},
+    {'pdb': '1hai', 'chain': 'H', 'seq_id': '99'},
+])
+def test_submit_rejects_invalid_requests(service, request_):
+    with pytest.raises(ValueError):
+        service.submit(request_)
+    assert not service.jobs and service.queue.empty()
+
+
+def test_submit_clamps_resources(service):
+    job = service.submit({'pdb': '1HAI', 'chain': 'h', 'n_procs': 10 ** 6, 'resamples': 10 ** 9,
+        'map_spacing': 0.01, 'map_extent': 1000, 'query_anchored': 'true'})
+    parameters = job['parameters']
+    assert job['query'] == '1hai_H' and job['status'] == 'queued'
+    assert parameters['n_procs'] == pywater.multiprocessing.cpu_count()
+    assert parameters['resamples'] == 10000
+    assert parameters['map_spacing'] == 0.5 and parameters['map_extent'] == 20.0
+    assert parameters['query_anchored'] is True
+    # no density map unless asked for
+    job = service.submit({'pdb': '1hai', 'chain': 'H', 'n_procs': 0})
+    assert job['parameters']['map_spacing'] == 0.0 and job['parameters']['n_procs'] == 1
+    with pytest.raises(pywater.Queue.Full):
+        service.submit({'pdb': '1hai', 'chain': 'H'})